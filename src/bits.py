@@ -0,0 +1,98 @@
+'''
+Packed bit-string representation of orbital occupations.
+
+A spin string is stored as a tuple of 64-bit words (python ints in
+[0, 2**64)); orbital n (1-indexed, as in vec.Det) is bit (n-1)%64 of word
+(n-1)//64. Trailing zero words are dropped, so equal occupations always
+give equal tuples and the tuples can be hashed and compared directly.
+'''
+
+WORD_BITS = 64
+WORD_MASK = (1 << WORD_BITS) - 1
+
+def pack(orbs):
+    '''Packs 1-indexed occupied orbitals into a tuple of 64-bit words'''
+    words = []
+    for orb in orbs:
+        w, b = divmod(int(orb) - 1, WORD_BITS)
+        if w >= len(words):
+            words += [0]*(w + 1 - len(words))
+        words[w] |= 1 << b
+    return trim(words)
+
+def unpack(words):
+    '''Sorted list of the 1-indexed orbitals occupied in words'''
+    orbs = []
+    for w, word in enumerate(words):
+        while word:
+            low = word & -word
+            orbs.append(w*WORD_BITS + low.bit_length())
+            word ^= low
+    return orbs
+
+def trim(words):
+    n = len(words)
+    while n and not words[n-1]:
+        n -= 1
+    return tuple(words[:n])
+
+def popcount(word):
+    return bin(word).count('1')
+
+def count(words):
+    return sum(popcount(word) for word in words)
+
+def _zip_words(words1, words2):
+    n = max(len(words1), len(words2))
+    return zip(tuple(words1) + (0,)*(n - len(words1)), tuple(words2) + (0,)*(n - len(words2)))
+
+def xor(words1, words2):
+    return trim([w1 ^ w2 for w1, w2 in _zip_words(words1, words2)])
+
+def and_(words1, words2):
+    return trim([w1 & w2 for w1, w2 in _zip_words(words1, words2)])
+
+def and_not(words1, words2):
+    '''Bits set in words1 but not in words2'''
+    return trim([w1 & ~w2 for w1, w2 in _zip_words(words1, words2)])
+
+def n_diff(words1, words2):
+    '''Number of orbitals occupied in exactly one of the two strings'''
+    return sum(popcount(w1 ^ w2) for w1, w2 in _zip_words(words1, words2))
+
+def flip(words, orb):
+    '''Toggles the occupation of (1-indexed) orbital orb'''
+    w, b = divmod(orb - 1, WORD_BITS)
+    words = list(words) + [0]*max(0, w + 1 - len(words))
+    words[w] ^= 1 << b
+    return trim(words)
+
+def count_between(words, orb1, orb2):
+    '''Number of occupied orbitals strictly between orb1 and orb2 (masked popcount)'''
+    lo, hi = (orb1, orb2) if orb1 < orb2 else (orb2, orb1)
+    #Orbitals lo+1, ..., hi-1 are the bit positions [first, end)
+    first, end = lo, hi - 1
+    res = 0
+    for w in range(first//WORD_BITS, min(end//WORD_BITS + 1, len(words))):
+        mask = WORD_MASK
+        if w == first//WORD_BITS:
+            mask &= WORD_MASK << (first%WORD_BITS)
+        if w == end//WORD_BITS:
+            mask &= (1 << (end%WORD_BITS)) - 1
+        res += popcount(words[w] & mask)
+    return res
+
+def excitation(words1, words2):
+    '''
+    Excitation taking spin string words1 to words2. Returns the orbitals
+    excited from, the orbitals excited to (paired in order) and the parity
+    of the excitation, found by applying the single excitations in turn and
+    counting the occupied orbitals each electron passes over.
+    '''
+    holes = unpack(and_not(words1, words2))
+    particles = unpack(and_not(words2, words1))
+    perm, words = 0, words1
+    for hole, particle in zip(holes, particles):
+        perm += count_between(words, hole, particle)
+        words = flip(flip(words, hole), particle)
+    return holes, particles, (-1 if perm%2 else 1)
@@ -16,7 +16,12 @@ from shci4qmc.src.ham import Ham
 class CsfMethods():
     def __init__(self):
         self.proj_matrix_rep = 'sparse'
+        #'dict' (vec.Vec) or 'array' (vec.ArrayVec)
+        self.vec_type = vec.vec_type(self.config.get('vec_rep', 'dict'))
         self.reduce_csfs = self.config['reduce_csfs']
+        #Print L2 diagnostics of the SHCI and csf wfs when project_l2 is set (the 
+        #important dets are printed with project_l2 either way, without projecting)
+        self.l2_diagnostics = self.config.get('l2_diagnostics', True)
 
         self.det_config_labels = None
         self.wf_csf_coeffs = None
@@ -64,13 +69,17 @@ class CsfMethods():
         print('projection err: %.10f' % perr)
         print('total err: %.10f'% err, ' (includes proj. err + csf_tol err + rotation err)')
         if self.config['project_l2']:
-            self.print_important_dets(dets, wf_coeffs, csfs, wf_csf_coeffs)
-            err_shci, err_proj = self.get_eigen_error(dets, wf_coeffs, csfs, wf_csf_coeffs)
-            print('SHCI eigen err: %.10f'% err_shci)
-            print('Proj eigen err: %.10f'% err_proj)
-            l2_shci, l2_proj = self.l2_expectation(dets, wf_coeffs, csfs, wf_csf_coeffs)
-            print('SHCI l2: %.10f'% l2_shci)
-            print('Proj l2: %.10f'% l2_proj)
+            wf_shci = self.sum_states(dets, wf_coeffs)
+            wf_proj = self.sum_states(csfs, wf_csf_coeffs)
+            self.print_important_dets(wf_shci, wf_proj)
+        if self.config['project_l2'] and self.l2_diagnostics:
+            shci_diag, proj_diag = self.get_l2_diagnostics(wf_shci, wf_proj)
+            print('SHCI eigen err: %.10f'% shci_diag.eigen_error())
+            print('Proj eigen err: %.10f'% proj_diag.eigen_error())
+            print('SHCI l2: %.10f'% shci_diag.expectation())
+            print('Proj l2: %.10f'% proj_diag.expectation())
+            print('SHCI l2 residual: %.10f'% shci_diag.residual_norm())
+            print('Proj l2 residual: %.10f'% proj_diag.residual_norm())
         csfs_data = [
             [(det_indices.index(d), csf.dets[d]) for d in csf.dets] for csf in csfs]
 
@@ -89,14 +98,14 @@ class CsfMethods():
         self.config_data = config_labels
         self.det_data = det_indices
         self.err = err
+        if self.L2projector is not None:
+            #Cached L op results are only valid for this molecule
+            self.L2projector.clear_caches()
         return
 #        return wf_csf_coeffs, csfs_info, config_labels, det_indices, err
 
     def sum_states(self, states, coefs):
-        res = vec.Vec.zero()
-        for state, coef in zip(states, coefs):
-            res += coef*state
-        return res
+        return self.vec_type.linear_combination(coefs, states)
 
 #    def det_to_list(self, det):
 #        up_orbs = [orb - 1 for orb in det.up_occ]
@@ -165,11 +174,16 @@ class CsfMethods():
     def get_csfs(self, dets):
         twice_s = self.get_2sz(dets)
         configs = set(vec.Config(det) for det in dets)
-        max_open = max([config.num_open for config in configs])
+        if self.csf_method == 'ls':
+            #Only configs without an ls pattern need spin csf templates
+            max_open = max([config.num_open for config in configs 
+                            if self.ls_pattern(config) is None] + [0])
+        else:
+            max_open = max([config.num_open for config in configs])
         print("Loading CSF data...\n");
-        csf_data = self.load_csf_file(max_open, twice_s)
-        print("Converting configs...\n");
-        csfs = self.configs2csfs(csf_data, configs)
+        with self.load_csf_file(max_open, twice_s) as csf_data:
+            print("Converting configs...\n");
+            csfs = self.configs2csfs(csf_data, configs)
         config_labels = [csf.config_label for csf in csfs]
         #self.save_l2_matrix(csfs)
         return csfs, config_labels
@@ -208,75 +222,34 @@ class CsfMethods():
         else:
             raise Exception('Unknown matrix rep \''+ self.proj_matrix_rep + '\' in get_proj_error')
 
-    def print_important_dets(self, dets, det_coeffs, csfs, csf_coeffs):
-        wf_shci, wf_proj = vec.Vec.zero(), vec.Vec.zero()
-        for det, coef in zip(dets, det_coeffs):
-            wf_shci += coef*det
-        for csf, coef in zip(csfs, csf_coeffs):
-            wf_proj += coef*csf
-        raw_proj = self.L2projector.project(self.target_l2, wf_shci)
-        larger_proj_coef = lambda det, coef: -abs(coef)
+    def get_l2_diagnostics(self, wf_shci, wf_proj):
+        '''L2Diagnostics of the SHCI wf and of the csf wf (L2 is applied once to each)'''
+        return (self.L2projector.diagnostics(self.target_l2, wf_shci), 
+                self.L2projector.diagnostics(self.target_l2, wf_proj))
+
+    def print_important_dets(self, wf_shci, wf_proj):
+        #wf_proj (the csf wf) is the projected wf; the SHCI wf isn't projected again
         all_dets = set(list(wf_proj.dets.keys()) + list(wf_shci.dets.keys()))
         important_dets = sorted(all_dets, key = lambda det: -abs(wf_proj.dets.get(det, 0.)))
         print('\nPrinting most important dets:')
-        print("Det:\t\t\tProjected Coef\tSHCI Coef\tDiff1\t Raw SHCI Proj Coef\t Diff2")
+        print("Det:\t\t\tProjected Coef\tSHCI Coef\tDiff")
         for det in important_dets:
             coef = wf_proj.dets.get(det, 0.)
             shci_coef = wf_shci.dets.get(det, 0.)
-            proj_coef = raw_proj.dets.get(det, 0.)
-            diff1 = abs(coef - shci_coef)
-            diff2 = abs(proj_coef - shci_coef)
-            print(det, ": %12.8f\t %12.8f\t %12.8f\t %12.8f\t %12.8f"% 
-                  (coef, shci_coef, diff1, proj_coef, diff2))
-        wf_proj += -1*wf_shci
-        print("WF Norm diff: %12.8f"% wf_proj.norm())
+            diff = abs(coef - shci_coef)
+            print(det, ": %12.8f\t %12.8f\t %12.8f"% (coef, shci_coef, diff))
+        wf_diff = self.vec_type.linear_combination([1, -1], [wf_proj, wf_shci])
+        print("WF Norm diff: %12.8f"% wf_diff.norm())
         print()
         return
 
     def get_error(self, dets, det_coeffs, csfs, csf_coeffs):
-        wf_diff = vec.Vec.zero()
-        for det, coef in zip(dets, det_coeffs):
-            wf_diff += coef*det
-        wf_norm = wf_diff.norm()
-        for csf, coef in zip(csfs, csf_coeffs):
-            wf_diff += -1*coef*csf
+        wf_shci = self.vec_type.linear_combination(det_coeffs, dets)
+        wf_norm = wf_shci.norm()
+        wf_diff = self.vec_type.linear_combination(
+            [1] + [-coef for coef in csf_coeffs], [wf_shci] + list(csfs))
         return (wf_diff.norm()/wf_norm)**2
 
-    def get_eigen_error(self, dets, det_coeffs, csfs, csf_coeffs):
-        wf_shci, wf_proj = vec.Vec.zero(), vec.Vec.zero()
-        for csf, coef in zip(csfs, csf_coeffs):
-            #csf_eig_err = self.L2projector.eigen_error(self.target_l2, csf)
-            #print('CSF eigen err: %10.8f'% csf_eig_err)
-            wf_proj += coef*csf
-        for det, coef in zip(dets, det_coeffs):
-            wf_shci += coef*det
-        #proj_wf = self.L2projector.project(self.target_l2, wf_shci)
-        #l2_error = self.L2projector.eigen_error(self.target_l2, proj_wf)
-        #diff = vec.Vec.zero()
-        #diff += proj_wf
-        #diff += -1*wf_shci
-        #print("proj.norm()/shci.norm(): %.8f"% (proj_wf.norm().real/wf_shci.norm()))
-        #print("Diff.norm(): %.8f"% diff.norm())
-        #print("\nProj * shci_wf: (err = %.8f)"% l2_error)
-        #coef_mag = lambda det, coef: -abs(coef)
-        #for det, coef in sorted(proj_wf.dets.items(), key = lambda p : coef_mag(*p)):
-        #    print(
-        #        det, "%12.8f"%coef.real, "%12.8f"%wf_shci.dets.get(det, 0.), 
-        #        "%12.8f"%wf_proj.dets.get(det, 0.))
-        shci_eigen_error = self.L2projector.eigen_error(self.target_l2, wf_shci)
-        proj_eigen_error = self.L2projector.eigen_error(self.target_l2, wf_proj)
-        return shci_eigen_error, proj_eigen_error
-    
-    def l2_expectation(self, dets, det_coeffs, csfs, csf_coeffs):
-        wf_shci, wf_proj = vec.Vec.zero(), vec.Vec.zero()
-        for csf, coef in zip(csfs, csf_coeffs):
-            wf_proj += coef*csf
-        for det, coef in zip(dets, det_coeffs):
-            wf_shci += coef*det
-        shci_l2 = self.L2projector.L2_expectation(wf_shci)
-        proj_l2 = self.L2projector.L2_expectation(wf_proj)
-        return shci_l2, proj_l2
-
     def det_indices_from_csfs(self, csfs, det_indices):
         for csf in csfs:
             for det in csf.dets:
@@ -353,9 +326,8 @@ class CsfMethods():
         csf_tol = self.config['csf_tol']
         csfs, wf_csf_coeffs, config_labels = [], [], []
         for label, config_csfs in config2csfs.items():
-            rotated_csf = vec.Vec.zero()
-            for coef, csf in config_csfs:
-                rotated_csf += coef*csf
+            rotated_csf = self.vec_type.linear_combination(
+                [coef for coef, csf in config_csfs], [csf for coef, csf in config_csfs])
             rotated_coef = rotated_csf.norm()
 
             csf_subspace = [rotated_csf] + [csf for coef, csf in config_csfs]
@@ -402,51 +374,22 @@ class CsfMethods():
         return det_config_labels
 
     def print_related_configs(self, dets, wf_coeffs):
-        def rep(config):
-            rep_occs = {}
-            for orb, num in config.occs.items():
-                porb = self.porbs[orb]
-                rep_orb = min(porb, orb)
-                if rep_orb not in rep_occs:
-                    rep_occs[rep_orb] = 0
-                rep_occs[rep_orb] += num
-            up, dn = [], []
-            for orb, num in rep_occs.items():
-                if num >= 1:
-                    up.append(orb)
-                if num >= 2:
-                    dn.append(orb)
-                if num >= 3:
-                    up.append(self.partner_orbs[orb])
-                if num >= 4:
-                    up.append(self.partner_orbs[orb])
-            return vec.Config(vec.Det(up, dn))
-        def av_weight(config_weight, related_configs, rep):
-            tot_weight = 0
-            for config in related_configs[rep]:
-                tot_weight += config_weight[config] 
-            return tot_weight/len(related_configs[rep])
-            
-
-        related_configs = {}
-        config_weight = {}
-        for det, coef in zip(dets, wf_coeffs):
-            config = vec.Config(det)
-            if config not in config_weight:
-                config_weight[config] = 0.
-            config_weight[config] += coef**2
-            if rep(config) not in related_configs:
-                related_configs[rep(config)] = set()
-            related_configs[rep(config)].update([config])
-        sorted_reps = sorted(
-            related_configs.keys(), 
-            key = lambda rep: -av_weight(config_weight, related_configs, rep))
-        for rep in sorted_reps: 
-            related = related_configs[rep]
+        #Configs related by moving electrons between partner orbitals, and their weights
+        configs = [vec.Config(det) for det in dets]
+        weights = numpy.array(wf_coeffs)**2
+        related_configs = []
+        for group in sy.group_rows(self.pair_occ_reps(vec.config_keys(configs))).values():
+            config_weight = {}
+            for n in group:
+                config_weight[configs[n]] = config_weight.get(configs[n], 0.) + weights[n]
+            related_configs.append(config_weight)
+        related_configs.sort(key = lambda config_weight: 
+                             -sum(config_weight.values())/len(config_weight))
+        for config_weight in related_configs:
             print("--------")
-            print('Size: ', len(related))
-            for config in related:
-                print('>>> ', config, math.sqrt(config_weight[config]))
+            print('Size: ', len(config_weight))
+            for config, weight in config_weight.items():
+                print('>>> ', config, math.sqrt(weight))
         assert(False)
     
 class IndexList:
@@ -1,95 +1,84 @@
 import sys
 import os
-import subprocess
+import multiprocessing
 #sys.path.append(os.path.join(os.path.dirname(__file__), '../lib'))
 
 from pyscf import symm
 import numpy as np
 import shci4qmc.src.vec as vec
+import shci4qmc.src.bits as bits
 import shci4qmc.src.symm as sy
+import shci4qmc.src.spin_csf as spin_csf
+import shci4qmc.src.ls_csf as ls_csf
+import shci4qmc.src.proj_l2 as proj_l2
 from shci4qmc.src.vec import Det, Vec, Config
 from shci4qmc.src.proj_l2 import L2Projector
 
+CSF_CACHE = 'csf_cache.npz'
+CSF_TEXT_CACHE = 'csf_cache.txt'
+
 class GenMethods():
     def __init__(self):
-        if self.config['project_l2']:
+        #worker processes (and configs or csf blocks per task) used in configs2csfs
+        self.n_workers = self.config.get('n_workers', 1)
+        self.chunk_size = self.config.get('chunk_size', 16)
+        #'spin': spin csfs of each config (projected onto target_l2 if project_l2); 
+        #'ls': L,S-adapted csfs of each atomic shell occupation (see ls_csf.py)
+        self.csf_method = self.config.get('csf_method', 'spin')
+        if self.csf_method not in ('spin', 'ls'):
+            raise Exception('Unknown csf method \'' + self.csf_method + '\' in GenMethods')
+        self.orb_shells = None
+        self.L2projector = None
+        if self.config['project_l2'] or self.csf_method == 'ls':
             assert(self.mol.is_atomic_system and self.symmetry == 'DOOH')
             #TODO: Add some tolerance options here? prune tol + mol matrix tol 
-            self.L2projector = L2Projector(self.mol, self.mf)
+            self.L2projector = L2Projector(
+                self.mol, self.mf, self.config.get('vec_rep', 'dict'), 
+                self.config.get('l2_rep', 'vec'), self.config.get('l2_cache_size', 100000),
+                proj_method = self.config.get('proj_method', 'lowdin'),
+                proj_tol = self.config.get('proj_tol', 1e-6),
+                proj_cache_file = self.config.get('proj_cache_file'),
+                proj_cache_size = self.config.get('proj_cache_size', 10000),
+                proj_max_dim = self.config.get('proj_max_dim', 200))
             self.target_l2 = self.config['target_l2']
 
     def parse_csf_file(self, num_open_shells_max, twice_s, csf_file_contents):
-        lines = csf_file_contents.split('\n')
-        max_nelecs = 0
-        blocks, csf_info = [], {}
+        csf_info, max_nelecs = {}, 0
         if (twice_s == 0): 
             csf_info[0] = ([[1]], [''])
-        while 'END' in lines:
-            blocks.append(lines[lines.index('START')+1:lines.index('END')])
-            lines = lines[lines.index('END')+1:]
-        for block in blocks:
-            header = block[0].split(' ')
-            n, s = int(header[2]), float(header[5])
-            coefs = []
-            if (n > num_open_shells_max):
-                break
-            if (twice_s/2. != s): 
-                continue
+        keep = lambda n, s: n <= num_open_shells_max and s == twice_s
+        for n, s, coefs, det_strs in read_csf_blocks(csf_file_contents.split('\n'), keep):
             max_nelecs = max(n, max_nelecs)
-            det_strs = block[1].split(' ')[:-1]
-            for line in block[2:]:
-                coefs.append([float(num) for num in line.split('\t')[:-1]])
             csf_info[n] = (coefs, det_strs)
         return csf_info, max_nelecs
 
     def make_csf_file(self, max_open, twice_s):
-        filename = "csf_cache.txt"
-        try:
-            f = open(filename, 'r')
-            raise Exception(cache_name + " already exists." + 
-                    "make_csf_file will not attempt to overwrite it")
-        except:
-            csf_gen_exe = os.path.join(os.path.dirname(__file__), '../lib/spin_csf_gen')
-            process = subprocess.Popen(
-                '%s %d'% (csf_gen_exe, max_open), shell=True, stdout=subprocess.PIPE,
-                universal_newlines = True)
-            csf_cache_file = open(filename, 'w+')
-            file_contents = ''
-            for line in iter(process.stdout.readline, ''):
-                csf_cache_file.write(line)
-                file_contents += line
-            csf_cache_file.close()
-
-#            csf_gen_exe = os.path.join(os.path.dirname(__file__), '../lib/spin_csf_gen')
-#            out_dir = '.'
-#            nelecs = str(max_open)
-#            subprocess.run([gen_script, out_dir, filename, nelecs])
-#            f = open(filename, 'r')
-#            file_contents = f.read()
-
-#            gen_script = os.path.join(os.path.dirname(__file__), '../bin/run_csfgen')
-#            out_dir = '.'
-#            nelecs = str(max_open)
-#            subprocess.run([gen_script, out_dir, filename, nelecs])
-#            f = open(filename, 'r')
-#            file_contents = f.read()
-            return self.parse_csf_file(sys.maxsize, twice_s, file_contents)
+        '''
+        Generates any CSF blocks with up to max_open open shells and 2S = twice_s 
+        missing from the cache, and adds them to it
+        '''
+        #n = 0 (closed shell, 2S = 0) is handled by CsfCache itself
+        needed = range(twice_s if twice_s else 2, max_open+1, 2)
+        arrays = {}
+        if os.path.exists(CSF_CACHE):
+            with np.load(CSF_CACHE) as npz:
+                missing = [n for n in needed if csf_cache_key('coefs', n, twice_s) not in npz.files]
+                if not missing:
+                    return
+                arrays = {key: npz[key] for key in npz.files}
+        else:
+            missing = needed
+        blocks = [(n, twice_s) + spin_csf.csf_block(n, twice_s) for n in missing]
+        write_csf_cache(CSF_CACHE, blocks, arrays)
 
     def load_csf_file(self, max_open, twice_s):
-        filename = "csf_cache.txt"
-        try:
-            f = open(filename, 'r')
-        except:
-            csf_info, max_nelecs = self.make_csf_file(max_open, twice_s)
-            return csf_info
-        file_contents = f.read()
-        csf_info, max_loaded = self.parse_csf_file(max_open, twice_s, file_contents)
-        if (max_loaded < max_open or len(csf_info) == 0):
-            raise Exception("Could not find CSFs with requested nelecs " + 
-                    "and/or spin eigenvalue in " + filename + 
-                    ". To re-calculate CSFS, remove " + filename + 
-                    " from the current directory.")
-        return csf_info
+        if not os.path.exists(CSF_CACHE) and os.path.exists(CSF_TEXT_CACHE):
+            #Migrate the old text cache
+            print("Converting " + CSF_TEXT_CACHE + " to " + CSF_CACHE + "...\n")
+            with open(CSF_TEXT_CACHE, 'r') as f:
+                write_csf_cache(CSF_CACHE, read_csf_blocks(f))
+        self.make_csf_file(max_open, twice_s)
+        return CsfCache(CSF_CACHE, twice_s)
 
 #def get_occ_combs(nup, nopen):
 #    def combs(n, r):
@@ -109,18 +98,37 @@ class GenMethods():
 
     def symm_configs(self, configs):
         #if mol is a sigma state, this avoids creating duplicate csfs
-        skip = set()
-        for config in configs:
-            if config in skip: continue
-            yield config
-            skip.update([config, self.partner_config(config)])
+        configs = list(configs)
+        partner_classes = sy.group_rows(self.partner_reps(vec.config_keys(configs)))
+        for group in partner_classes.values():
+            yield configs[group[0]]
 
     def configs2csfs(self, csf_cache, configs):
         csfs, config_labels = [], []
         if self.symmetry in ('DOOH', 'COOV'):
             configs = self.symm_configs(configs)
-        for n, config in enumerate(configs):
-            config_csfs = list(self.config2csfs(csf_cache, config))
+        if self.csf_method == 'ls':
+            configs = self.ls_configs(configs)
+        configs = list(configs)
+        if self.csf_method == 'ls':
+            #ls csfs don't use the spin csf templates; configs without an ls 
+            #pattern build theirs in config2csfs
+            config_keys = [None]*len(configs)
+        else:
+            config_keys = self.template_keys(csf_cache, configs)
+        tasks = list(zip(configs, config_keys))
+        if self.n_workers > 1 and len(tasks) > 1:
+            #imap returns results in task order, so output matches the serial loop
+            all_csfs = fork_map(config2csfs_task, (self, csf_cache), tasks, 
+                                self.n_workers, self.chunk_size)
+        else:
+            all_csfs = [config2csfs_task((self, csf_cache), task) for task in tasks]
+        for n, (config_csfs, projections) in enumerate(all_csfs):
+            if projections:
+                #Keep projections made by forked workers (no-op in the serial loop)
+                self.L2projector.proj_cache.update(projections)
+            #With csf_method 'ls', n labels the whole ls pattern group of the config 
+            #(see ls_configs), since its ls csfs span all the configs in the group
             for csf in config_csfs:
                 csf.config_label = n
             csfs += config_csfs
@@ -129,7 +137,7 @@ class GenMethods():
             print('--------')
             for det, coef in csf.dets.items():
                 print(det, "%12.8f"% coef)
-        csfs = Vec.gram_schmidt(csfs, len(csfs), tol=1e-4)
+        csfs = self.orthonormalize_blocks(csfs)
         print('After GS csfs:')
         for csf in csfs:
             print('--------')
@@ -137,21 +145,73 @@ class GenMethods():
                 print(det, "%12.8f"% coef)
         return csfs
 
-    def config2csfs(self, csf_cache, config):
-        nopen = len([orb for orb in config.occs if config.occs[orb] == 1])
-        csfs_coefs, index2occs = csf_cache[nopen]
-        dets = [self.make_det(occs, config) for occs in index2occs]
+    def orthonormalize_blocks(self, csfs):
+        '''
+        Gram-Schmidt on each block of csfs with overlapping det supports; csfs 
+        in different blocks are orthogonal already. Same result (and order) 
+        as Vec.gram_schmidt(csfs, len(csfs), tol=1e-4).
+        '''
+        blocks = csf_blocks(csfs)
+        if self.n_workers > 1 and len(blocks) > 1:
+            orth_blocks = fork_map(gram_schmidt_task, csfs, blocks, 
+                                   self.n_workers, self.chunk_size)
+        else:
+            orth_blocks = [gram_schmidt_task(csfs, block) for block in blocks]
+        #gram_schmidt keeps the input order, so sort kept csfs by input position
+        indexed = []
+        for block, orth in zip(blocks, orth_blocks):
+            for n, csf in orth:
+                indexed.append((block[n], csf))
+        return [csf for n, csf in sorted(indexed, key = lambda item: item[0])]
+
+    def template_keys(self, csf_cache, configs):
+        '''
+        Packed dets (see instantiate_template) of the csf template of each config, 
+        built in one batch per number of open shells
+        '''
+        config_keys = [None]*len(configs)
+        by_nopen = {}
+        for n, config in enumerate(configs):
+            by_nopen.setdefault(config.num_open, []).append(n)
+        max_orb = max([max(config.occs) for config in configs if config.occs] + [1])
+        n_words = (max_orb - 1)//bits.WORD_BITS + 1
+        for nopen, indices in by_nopen.items():
+            csfs_coefs, index2occs = csf_cache[nopen]
+            occ = np.array([[c == '1' for c in occs] for occs in index2occs], dtype=bool)
+            closed = [sorted(orb for orb in configs[n].occs if configs[n].occs[orb] == 2) 
+                      for n in indices]
+            opens = [sorted(orb for orb in configs[n].occs if configs[n].occs[orb] == 1) 
+                     for n in indices]
+            keys = instantiate_template(
+                np.array(closed, dtype=np.int64).reshape(len(indices), len(closed[0])),
+                np.array(opens, dtype=np.int64).reshape(len(indices), nopen),
+                occ.reshape(len(index2occs), nopen), n_words)
+            for n, config_key in zip(indices, keys):
+                config_keys[n] = config_key
+        return config_keys
+
+    def config2csfs(self, csf_cache, config, keys = None):
+        if self.csf_method == 'ls' and self.ls_pattern(config) is not None:
+            return np.array(self.ls_csfs(config, csf_cache.twice_s))
+        csfs_coefs, index2occs = csf_cache[config.num_open]
+        if keys is None:
+            keys = self.template_keys(csf_cache, [config])[0]
+        if self.symmetry in ('DOOH', 'COOV'):
+            dets = [self.convert_det(det) for det in vec.keys2dets(keys)]
+            make_csf = lambda coefs: self.vec_type.linear_combination(coefs, dets)
+        elif self.vec_type is vec.ArrayVec:
+            make_csf = lambda coefs: vec.ArrayVec.fromarrays(keys, coefs)
+        else:
+            dets = vec.keys2dets(keys)
+            make_csf = lambda coefs: Vec(dict(zip(dets, coefs)))
         csfs = []
+        #With csf_method 'ls', configs without an ls pattern are projected instead
+        project = self.config['project_l2'] or self.csf_method == 'ls'
         for coefs in csfs_coefs:
-            csf = Vec.zero()
-            for n, coef in enumerate(coefs):
-                det = dets[n] 
-                if self.symmetry in ('DOOH', 'COOV'):
-                    det = self.convert_det(det)
-                csf += coef*det
-            if self.config['project_l2']:
+            csf = make_csf(coefs)
+            if project:
                 start = csf
-                csf = self.L2projector.project(self.target_l2, csf)
+                csf = self.L2projector.project_csf(self.target_l2, csf)
                 err = self.L2projector.eigen_error(self.target_l2, csf)
                 #if l2_error is too large, skip this csf
                 if err > 1e-1 or csf.norm() < 1e-2:
@@ -169,6 +229,129 @@ class GenMethods():
                 csfs.append(csf)
         return np.array(csfs)
 
+    def get_orb_shells(self):
+        '''
+        Atomic shells of the (complex) orbitals: {orb: (shell, l, label, phase)}, 
+        where shell is the shell's orbital with m = -l, label = m + l + 1 (as in 
+        ls_csf) and orb = phase*|l m> with |l m> in the Condon-Shortley convention. 
+        m is the L2projector's lz (in this basis; it needn't agree in sign with 
+        orb2lz) and shells are followed from m = -l with its lup, phases fixed by 
+        its matrix elements. Orbitals of mixed l, or that lz doesn't keep or lup 
+        doesn't take to a single orbital, are left out.
+        '''
+        norb = len(self.orb2lz)
+        #complex orbital orb = sum_r C[r-1, orb-1] real orbital r
+        C = np.zeros((norb, norb), dtype=complex)
+        for orb in range(1, norb+1):
+            for coef, [real_orb] in self.real_orbs([orb]):
+                C[real_orb-1, orb-1] = coef
+        to_complex = lambda op: np.linalg.solve(C, proj_l2.csr_op(op).toarray().T.dot(C))
+        lz, lup = to_complex(self.L2projector.lz_tot), to_complex(self.L2projector.lup_tot)
+        tol = self.L2projector.op_tol
+        ang_mom = self.L2projector.ang_mom
+        pure_l, orb_m = {}, {}
+        for orb in range(1, norb+1):
+            m = lz[orb-1, orb-1].real
+            off_diag = np.delete(abs(lz[:, orb-1]), orb-1)
+            if (len(ang_mom[orb]) == 1 and abs(m - round(m)) < tol and 
+                    (len(off_diag) == 0 or off_diag.max() < tol)):
+                pure_l[orb], orb_m[orb] = list(ang_mom[orb])[0], int(round(m))
+        raised = {}
+        for orb, l in pure_l.items():
+            m = orb_m[orb]
+            if m == l:
+                continue
+            new = np.argmax(abs(lup[:, orb-1])) + 1
+            elem = lup[new-1, orb-1]
+            if (pure_l.get(new) == l and orb_m[new] == m+1 and 
+                    abs(abs(elem) - np.sqrt(l*(l+1) - m*(m+1))) < tol):
+                raised[orb] = (new, elem/abs(elem))
+        orb_shells = {}
+        for shell, l in pure_l.items():
+            if orb_m[shell] != -l:
+                continue
+            orbs, phases = [shell], [1.]
+            while len(orbs) < 2*l+1 and orbs[-1] in raised:
+                #lup orb_m = sqrt(...)*(phase_m/phase_m+1)*orb_m+1
+                new, elem_phase = raised[orbs[-1]]
+                orbs.append(new)
+                phases.append(phases[-1]*np.conj(elem_phase))
+            if len(orbs) == 2*l+1:
+                for label, (orb, phase) in enumerate(zip(orbs, phases)):
+                    orb_shells[orb] = (shell, l, label+1, phase)
+        missing = sorted(orb for orb in pure_l if orb not in orb_shells)
+        if self.mol.is_atomic_system and missing:
+            raise Exception('Orbitals ' + str(missing) + ' of an atom not in any shell in get_orb_shells')
+        return orb_shells
+
+    def ls_pattern(self, config):
+        '''
+        ((shell, l, k) for each shell config occupies, M_L of config), or None 
+        if some orbital of config isn't in a shell (see get_orb_shells)
+        '''
+        if self.orb_shells is None:
+            self.orb_shells = self.get_orb_shells()
+        if any(orb not in self.orb_shells for orb in config.occs):
+            return None
+        counts = {}
+        for orb, occ in config.occs.items():
+            shell, l, label, phase = self.orb_shells[orb]
+            counts[shell] = counts.get(shell, 0) + occ
+        M = sum((self.orb_shells[orb][2] - self.orb_shells[orb][1] - 1)*occ 
+                for orb, occ in config.occs.items())
+        shells = tuple((shell, self.orb_shells[shell][1], counts[shell]) 
+                       for shell in sorted(counts))
+        return shells, M
+
+    def ls_configs(self, configs):
+        #One config per ls pattern group: configs with the same shell occupations 
+        #(and M_L) give the same ls csfs
+        seen = set()
+        for config in configs:
+            pattern = self.ls_pattern(config)
+            if pattern is not None and pattern in seen:
+                continue
+            seen.add(pattern)
+            yield config
+
+    def ls_csfs(self, config, twice_s):
+        '''
+        csfs with L = target_l2, S = M_S = twice_s/2 and the M_L of config, spanning 
+        the shell occupations of config, built by ls_csf.ls_states (no projection). 
+        Returned in the real orbital basis, like the csfs of config2csfs.
+        '''
+        shells, M = self.ls_pattern(config)
+        states = ls_csf.ls_states(
+            tuple((l, k) for shell, l, k in shells), self.target_l2, twice_s, M)
+        #ls_csf labels -> orbitals (and Condon-Shortley phase of each)
+        labels, phases, offset = {}, {}, 0
+        for shell, l, k in shells:
+            for orb, (orb_shell, orb_l, label, phase) in self.orb_shells.items():
+                if orb_shell == shell:
+                    labels[offset + label], phases[offset + label] = orb, phase
+            offset += 2*l + 1
+        csfs = []
+        for state in states:
+            coefs, dets = [], []
+            for (up, dn), coef in state.items():
+                #|l m> = conj(phase)*orb
+                coefs.append(coef*np.prod([np.conj(phases[label]) for label in up + dn]))
+                dets.append(Det(up, dn))
+            csf = proj_l2.relabel(Vec.linear_combination(coefs, dets), labels)
+            #Real (or imaginary) part, in the real orbital basis
+            rcoefs, rdets = [], []
+            for det, coef in csf.dets.items():
+                rdet, idet = self.convert_det_helper(det)
+                if self.use_real_part:
+                    rcoefs += [coef.real, -coef.imag]
+                else:
+                    rcoefs += [coef.imag, coef.real]
+                rdets += [rdet, idet]
+            csf = self.vec_type.linear_combination(rcoefs, rdets)
+            if csf.norm() > 1e-8:
+                csfs.append(csf)
+        return csfs
+
     def check_orthogonal(self, csfs):
         for n, csf1 in enumerate(csfs):
             for m, csf2 in enumerate(csfs):
@@ -177,22 +360,141 @@ class GenMethods():
                 if (csf1.dot(csf2) > 1e-2):
                     print('Not orthogonal: ', csf1.dot(csf2)) 
 
-    def make_det(self, occ_str, config):
-        up_occs, dn_occs, orbs, is_open = [], [], [], {}
-        orbs = sorted([orb for orb in config.occs])
-        for orb in orbs:
-            if config.occs[orb] == 1:
-                if occ_str[0] == '1':
-                    up_occs.append(orb)
-                    occ_str = occ_str[1:]
-                else:
-                    dn_occs.append(orb)
-                    occ_str = occ_str[1:]
-            else:
-                up_occs.append(orb)
-                dn_occs.append(orb)
-        assert(occ_str == '')
-        return Det(up_occs, dn_occs)
+def instantiate_template(closed, opens, occ, n_words):
+    '''
+    Dets of a csf template for a batch of configs with the same number of 
+    open shells, as ArrayVec keys. closed[c]/opens[c] are the (1-indexed) doubly 
+    and singly occupied orbitals of config c, with opens[c] sorted, and 
+    occ[j, k] is True if open shell k is up in template det j. Returns uint64 
+    keys[c, j] = (up words, dn words) of det j of config c.
+    '''
+    closed_words = np.bitwise_or.reduce(vec.orb_words(closed, n_words), axis=1)
+    open_words = vec.orb_words(opens, n_words)[:, None, :, :]
+    is_up = occ[None, :, :, None]
+    zero = np.uint64(0)
+    up = np.bitwise_or.reduce(np.where(is_up, open_words, zero), axis=2)
+    dn = np.bitwise_or.reduce(np.where(is_up, zero, open_words), axis=2)
+    closed_words = closed_words[:, None, :]
+    return np.concatenate((closed_words | up, closed_words | dn), axis=2)
+
+def csf_cache_key(kind, n, twice_s):
+    return '%s_n%d_s%d'% (kind, n, twice_s)
+
+def read_csf_blocks(lines, keep = lambda n, twice_s: True):
+    '''
+    Single pass over the text CSF format (as written by the old spin_csf_gen 
+    executable). Yields 
+    (n, twice_s, coefs, det_strs) for each START ... END block; coefficients 
+    are only parsed for blocks with keep(n, twice_s).
+    '''
+    lines = (line.rstrip('\n') for line in lines)
+    for line in lines:
+        if line != 'START':
+            continue
+        header = next(lines).split(' ')
+        n, twice_s = int(header[2]), int(round(2*float(header[5])))
+        det_strs = next(lines).split(' ')[:-1]
+        rows = []
+        for line in lines:
+            if line == 'END':
+                break
+            rows.append(line)
+        if keep(n, twice_s):
+            coefs = [[float(num) for num in row.split('\t')[:-1]] for row in rows]
+            yield n, twice_s, coefs, det_strs
+
+def write_csf_cache(filename, blocks, arrays = {}):
+    arrays = dict(arrays)
+    for n, twice_s, coefs, det_strs in blocks:
+        arrays[csf_cache_key('coefs', n, twice_s)] = np.array(coefs)
+        arrays[csf_cache_key('dets', n, twice_s)] = np.array(det_strs)
+    np.savez(filename, **arrays)
+
+class CsfCache:
+    '''
+    CSF templates for one value of 2S stored in a csf_cache.npz file. 
+    cache[n] = (coefs, det_strs) for n open shells, where coefs[i][j] is the 
+    coefficient of the open-shell det det_strs[j] in csf i. Blocks are only 
+    read from the file the first time they're requested, so the file stays open 
+    until close() (or the end of a with block).
+    '''
+    def __init__(self, filename, twice_s):
+        self.npz = np.load(filename)
+        self.twice_s = twice_s
+        self.blocks = {}
+        if (twice_s == 0):
+            self.blocks[0] = ([[1]], [''])
+
+    def __getitem__(self, n):
+        if n not in self.blocks:
+            coefs = self.npz[csf_cache_key('coefs', n, self.twice_s)]
+            det_strs = self.npz[csf_cache_key('dets', n, self.twice_s)].tolist()
+            self.blocks[n] = (coefs, det_strs)
+        return self.blocks[n]
+
+    def close(self):
+        self.npz.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def csf_blocks(csfs):
+    '''
+    Partitions csf indices into blocks of csfs connected by shared dets (e.g. 
+    the csfs of one config, or of a config and its partner config)
+    '''
+    parent = list(range(len(csfs)))
+    def find(n):
+        while parent[n] != n:
+            parent[n] = parent[parent[n]]
+            n = parent[n]
+        return n
+    det_owner = {}
+    for n, csf in enumerate(csfs):
+        for det in csf.dets:
+            m = det_owner.setdefault(det, n)
+            parent[find(m)] = find(n)
+    blocks = {}
+    for n in range(len(csfs)):
+        blocks.setdefault(find(n), []).append(n)
+    return list(blocks.values())
+
+_fork_state = None
+
+def fork_map(func, state, tasks, n_workers, chunk_size):
+    '''
+    [func(state, task) for task in tasks] on a pool of forked worker processes. 
+    state is inherited by the workers through fork instead of being pickled; 
+    only the tasks and results are sent between processes.
+    '''
+    global _fork_state
+    _fork_state = (func, state)
+    try:
+        with multiprocessing.get_context('fork').Pool(n_workers) as pool:
+            return list(pool.imap(_fork_call, tasks, chunk_size))
+    finally:
+        _fork_state = None
+
+def _fork_call(task):
+    func, state = _fork_state
+    return func(state, task)
+
+def config2csfs_task(state, task):
+    #csfs of the config, and the projections they added to the proj cache
+    gen_methods, csf_cache = state
+    config, keys = task
+    csfs = list(gen_methods.config2csfs(csf_cache, config, keys))
+    projector = gen_methods.L2projector
+    return csfs, (projector.pop_new_projections() if projector is not None else [])
+
+def gram_schmidt_task(csfs, block):
+    #(position in block, csf) of each orthonormalized csf kept
+    orth, kept = Vec.gram_schmidt([csfs[n] for n in block], len(block), 
+                                  tol=1e-4, return_indices=True)
+    return list(zip(kept, orth))
 
 #def parity(det):
 #    #computes parity relative to ordering s.t. up/down spins for the same
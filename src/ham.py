@@ -1,5 +1,6 @@
 import numpy as np
 import shci4qmc.lib.load_wf as load_wf
+import shci4qmc.src.bits as bits
 
 class Ham:
     def __init__(self, filename = 'FCIDUMP', real_orbs = True):
@@ -19,7 +20,7 @@ class Ham:
 
         # The one-electron hamiltonian in the spin-orbital basis 
         self.h1 = None
-        # The two-electron hamiltonian in the spin-orbital basis
+        # The two-electron hamiltonian, indexed in the spin-orbital basis (see PackedERI)
         # Note that eri[i,j,k,l] = < phi_i(r_1) phi_k(r_2) | 1/r12 | phi_j(r_1) phi_l(r_2) >
         # This ordering is called 'chemical ordering', and means that the first two indices of the array
         # define the charge density for electron 1, and the second two for electron two.
@@ -43,7 +44,7 @@ class Ham:
 
         as well as the integrals defining the hamiltonian terms:
         self.h1[:,:]        # A self.spin_basis x self.spin_basis matrix of one-electron terms
-        self.h2[:,:,:,:]    # A rank-4 self.spin_basis array for the two electron terms
+        self.h2[:,:,:,:]    # A PackedERI indexed like a rank-4 self.spin_basis array for the two electron terms
         self.nn             # The (scalar) nuclear repulsion energy
 
         Note that the integrals are defined in the spin-orbital basis, and the self.h2 term is defined as follows:
@@ -82,8 +83,8 @@ class Ham:
         # We order things with alpha, then beta spins
         self.spin_basis = 2*self.nbasis
         self.h1 = np.zeros((self.spin_basis, self.spin_basis))
-        # Ignore permutational symmetry
-        self.h2 = np.zeros((self.spin_basis, self.spin_basis, self.spin_basis, self.spin_basis))
+        # Packed over permutational symmetry and spin, see PackedERI
+        self.h2 = PackedERI(self.nbasis, self.real_orbs)
         dat = finp.readline().split()
         while dat:
             ii, jj, kk, ll = [int(x) for x in dat[1:5]] # Note these are 1-indexed
@@ -93,49 +94,9 @@ class Ham:
             l = ll-1
             if kk != 0:
                 # Two electron integral - 8 spatial permutations x 4 spin (=32) allowed permutations!
-                # alpha, alpha, alpha, alpha
-                self.h2[i, j, k, l] = float(dat[0])
-                self.h2[j, i, l, k] = float(dat[0])
-                self.h2[k, l, i, j] = float(dat[0])
-                self.h2[l, k, j, i] = float(dat[0])
-                if self.real_orbs:
-                    self.h2[j, i, k, l] = float(dat[0])
-                    self.h2[i, j, l, k] = float(dat[0])
-                    self.h2[l, k, i, j] = float(dat[0])
-                    self.h2[k, l, j, i] = float(dat[0])
-
-                # beta, beta, beta, beta
-                self.h2[i+self.nbasis, j+self.nbasis, k+self.nbasis, l+self.nbasis] = float(dat[0])
-                self.h2[j+self.nbasis, i+self.nbasis, l+self.nbasis, k+self.nbasis] = float(dat[0])
-                self.h2[k+self.nbasis, l+self.nbasis, i+self.nbasis, j+self.nbasis] = float(dat[0])
-                self.h2[l+self.nbasis, k+self.nbasis, j+self.nbasis, i+self.nbasis] = float(dat[0])
-                if self.real_orbs:
-                    self.h2[j+self.nbasis, i+self.nbasis, k+self.nbasis, l+self.nbasis] = float(dat[0])
-                    self.h2[i+self.nbasis, j+self.nbasis, l+self.nbasis, k+self.nbasis] = float(dat[0])
-                    self.h2[l+self.nbasis, k+self.nbasis, i+self.nbasis, j+self.nbasis] = float(dat[0])
-                    self.h2[k+self.nbasis, l+self.nbasis, j+self.nbasis, i+self.nbasis] = float(dat[0])
-
-                # alpha, alpha, beta, beta
-                self.h2[i, j, k+self.nbasis, l+self.nbasis] = float(dat[0])
-                self.h2[j, i, l+self.nbasis, k+self.nbasis] = float(dat[0])
-                self.h2[k, l, i+self.nbasis, j+self.nbasis] = float(dat[0])
-                self.h2[l, k, j+self.nbasis, i+self.nbasis] = float(dat[0])
-                if self.real_orbs:
-                    self.h2[j, i, k+self.nbasis, l+self.nbasis] = float(dat[0])
-                    self.h2[i, j, l+self.nbasis, k+self.nbasis] = float(dat[0])
-                    self.h2[l, k, i+self.nbasis, j+self.nbasis] = float(dat[0])
-                    self.h2[k, l, j+self.nbasis, i+self.nbasis] = float(dat[0])
-
-                # beta, beta, alpha, alpha
-                self.h2[i+self.nbasis, j+self.nbasis, k, l] = float(dat[0])
-                self.h2[j+self.nbasis, i+self.nbasis, l, k] = float(dat[0])
-                self.h2[k+self.nbasis, l+self.nbasis, i, j] = float(dat[0])
-                self.h2[l+self.nbasis, k+self.nbasis, j, i] = float(dat[0])
-                if self.real_orbs:
-                    self.h2[j+self.nbasis, i+self.nbasis, k, l] = float(dat[0])
-                    self.h2[i+self.nbasis, j+self.nbasis, l, k] = float(dat[0])
-                    self.h2[l+self.nbasis, k+self.nbasis, i, j] = float(dat[0])
-                    self.h2[k+self.nbasis, l+self.nbasis, j, i] = float(dat[0])
+                # Only the unique spatial integral is stored, the spin and
+                # permutational images are recovered by index arithmetic in PackedERI
+                self.h2.set(i, j, k, l, float(dat[0]))
 
             elif kk == 0:
                 if jj != 0:
@@ -187,8 +148,6 @@ class Ham:
             # Two electron part to single excitation
             for i in det:
                 hel += ( self.h2[excit_mat[0][0], excit_mat[1][0], i, i] - self.h2[excit_mat[0][0], i, i, excit_mat[1][0]] )
-                two_b_dir = self.h2[excit_mat[0][0], excit_mat[1][0], i, i]
-                two_b_exc = self.h2[excit_mat[0][0], i, i, excit_mat[1][0]]
 
             # Multiply by the parity of the excitation
             hel *= parity
@@ -202,19 +161,69 @@ class Ham:
             hel *= parity
         return hel
 
-    def energy_of(self, dets, coefs):
+    def energy_of(self, dets, coefs, bit_dets = None):
+        ''' dets are lists of occupied spin-orbitals (see det_to_list). bit_dets, if given,
+        are the same determinants as (alpha, beta) packed strings (see bits.py).'''
+        if bit_dets is None:
+            bit_dets = [self.list_to_bits(det) for det in dets]
         energy, norm = 0, 0
-        for i in range(len(dets)):
-            det, d_coef = dets[i], coefs[i]
-            norm += d_coef**2
-            energy += (d_coef**2)*self.slater_condon(det, det, None, 1)
-            for j in range(i+1, len(dets)):
-                excited_det, e_coef = dets[j], coefs[j]
-                excit_mat, parity = calc_excit_mat_parity(det, excited_det)
-                mat_elem = self.slater_condon(det, excited_det, excit_mat, parity)
-                energy += 2*d_coef*e_coef*mat_elem
+        for det, coef in zip(dets, coefs):
+            norm += coef**2
+            energy += (coef**2)*self.slater_condon(det, det, None, 1)
+        # Only singly/doubly connected pairs have non-zero off-diagonal elements
+        for i, j in self.connected_pairs(bit_dets):
+            excit_mat, parity = self.excit_mat_parity(bit_dets[i], bit_dets[j])
+            mat_elem = self.slater_condon(dets[i], dets[j], excit_mat, parity)
+            energy += 2*coefs[i]*coefs[j]*mat_elem
         return energy/norm
 
+    def connected_pairs(self, dets):
+        ''' Yield each pair of indices (i, j), i < j, of determinants in dets (packed
+        (alpha, beta) strings, see bits.py) that differ by a single or double excitation.
+
+        Rather than comparing all pairs, determinants are bucketed by their alpha
+        string (beta singles/doubles), their beta string (alpha singles/doubles) and
+        by their alpha string with one orbital removed (opposite-spin doubles), in
+        the spirit of the helper strings used by SHCI. Every connected pair is found
+        in exactly one bucket, and is tested by popcounts of the XOR'd strings.'''
+        by_up, by_dn, up_helpers = {}, {}, {}
+        for n, (up, dn) in enumerate(dets):
+            by_up.setdefault(up, []).append(n)
+            by_dn.setdefault(dn, []).append(n)
+            for orb in bits.unpack(up):
+                up_helpers.setdefault(bits.flip(up, orb), []).append(n)
+
+        # Same-spin singles and doubles (2 or 4 differing orbitals)
+        for buckets, spin in ((by_dn, 0), (by_up, 1)):
+            for bucket in buckets.values():
+                for m, i in enumerate(bucket):
+                    for j in bucket[m+1:]:
+                        if 0 < bits.n_diff(dets[i][spin], dets[j][spin]) <= 4:
+                            yield (i, j) if i < j else (j, i)
+
+        # Opposite-spin doubles: alpha strings differ by exactly one orbital (they
+        # share exactly one helper) and the beta strings by exactly one orbital
+        for bucket in up_helpers.values():
+            for m, i in enumerate(bucket):
+                for j in bucket[m+1:]:
+                    if dets[i][0] != dets[j][0] and bits.n_diff(dets[i][1], dets[j][1]) == 2:
+                        yield (i, j) if i < j else (j, i)
+
+    def excit_mat_parity(self, det, excited_det):
+        ''' Excitation between two packed (alpha, beta) strings (excitations of each other).
+        Returns the excitation matrix in spin-orbital indices and the parity.'''
+        up_from, up_to, up_parity = bits.excitation(det[0], excited_det[0])
+        dn_from, dn_to, dn_parity = bits.excitation(det[1], excited_det[1])
+        excit_mat = [
+            tuple([orb - 1 for orb in up_from] + [orb - 1 + self.nbasis for orb in dn_from]),
+            tuple([orb - 1 for orb in up_to] + [orb - 1 + self.nbasis for orb in dn_to])]
+        return excit_mat, up_parity*dn_parity
+
+    def list_to_bits(self, det):
+        up = bits.pack([orb + 1 for orb in det if orb < self.nbasis])
+        dn = bits.pack([orb + 1 - self.nbasis for orb in det if orb >= self.nbasis])
+        return up, dn
+
     def det_to_list(self, det):
         up_orbs = [orb - 1 for orb in det.up_occ]
         dn_orbs = [orb - 1 + self.nbasis for orb in det.dn_occ] 
@@ -222,53 +231,48 @@ class Ham:
 
     def expectation(self, wf):
         dets = [self.det_to_list(det) for det in wf.dets.keys()]
+        bit_dets = [(det.up_bits, det.dn_bits) for det in wf.dets.keys()]
         coefs = [coef for coef in wf.dets.values()]
-        return self.energy_of(dets, coefs)
-
-def elec_exchange_ops(det, ind):
-    ''' Given a determinant defined by a list of occupied orbitals
-    which is ordered apart from one element (ind), find the number of
-    local (nearest neighbour) electron exchanges required to order the 
-    list of occupied orbitals.
-    
-    We can assume that there are no repeated elements of the list, and that
-    the list is ordered apart from one element on entry.
-    
-    Return: The number of pairwise permutations required.'''
-
-    a_orb = det[ind]
-    det_sort = sorted(det)
-    newind = det_sort.index(a_orb)
-    perm = abs(newind - ind)
-    return perm
-
-def calc_excit_mat_parity(det, excited_det):
-    ''' Given two determinants (excitations of each other), calculate and return 
-    the excitation matrix (see the definition in the slater-condon function), 
-    and parity of the excitation'''
-
-    # First, we have to compute the indices which are different in the two orbital lists.
-    excit_mat = []
-    excit_mat.append(tuple(set(det) - set(excited_det)))    # These are the elements in det which are not in excited_det
-    excit_mat.append(tuple(set(excited_det) - set(det)))    # These are the elements in excited_det which are not in det
-    assert(len(excit_mat[0]) == len(excit_mat[1]))
-
-    # Now find the parity
-    new_det = det[:]
-    perm = 0
-    for elec in range(len(excit_mat[0])):
-
-        # Find the index of the electron we want to remove
-        ind_elec = new_det.index(excit_mat[0][elec])
-        # Substitute the new electron
-        new_det[ind_elec] = excit_mat[1][elec]
-        # Find the permutation of this replacement
-        perm += elec_exchange_ops(new_det, ind_elec)
-        # Reorder the determinant
-        new_det.sort()
-    assert(new_det == excited_det)
-
-    return excit_mat, (-1)**perm
+        return self.energy_of(dets, coefs, bit_dets)
+
+class PackedERI:
+    ''' Two-electron integrals stored over unique spatial orbital quadruples only.
+    With real orbitals the full 8-fold permutational symmetry is used, with pairs
+    packed as in pyscf's ao2mo.restore(8, ...), so the storage is ~n^4/8 doubles.
+    With complex orbitals only (ij|kl) = (kl|ij) = (ji|lk) = (lk|ji) holds, so ordered
+    orbital pairs are kept and only the pair-pair symmetry is packed (~n^4/2).
+
+    Indexing with spin-orbital indices, h2[p, q, r, s], gives the same value as the
+    dense (2n)^4 array previously held by Ham: alpha orbitals are 0..n-1, beta orbitals
+    n..2n-1, and the integral vanishes unless p, q and r, s have equal spins.'''
+
+    def __init__(self, norb, real_orbs = True):
+        self.norb = norb
+        self.real_orbs = real_orbs
+        npair = norb*(norb+1)//2 if real_orbs else norb*norb
+        self.eri = np.zeros(npair*(npair+1)//2)
+
+    def pair_index(self, i, j):
+        if not self.real_orbs:
+            return i*self.norb + j
+        return i*(i+1)//2 + j if i >= j else j*(j+1)//2 + i
+
+    def index(self, i, j, k, l):
+        ij, kl = self.pair_index(i, j), self.pair_index(k, l)
+        return ij*(ij+1)//2 + kl if ij >= kl else kl*(kl+1)//2 + ij
+
+    def set(self, i, j, k, l, val):
+        ''' Store (ij|kl) (0-indexed spatial orbitals) and its symmetry images '''
+        self.eri[self.index(i, j, k, l)] = val
+        if not self.real_orbs:
+            self.eri[self.index(j, i, l, k)] = val
+
+    def __getitem__(self, spin_orbs):
+        p, q, r, s = spin_orbs
+        n = self.norb
+        if (p < n) != (q < n) or (r < n) != (s < n):
+            return 0.
+        return self.eri[self.index(p % n, q % n, r % n, s % n)]
 
 if __name__ == '__main__':
     # Test for hamiltonian matrix elements
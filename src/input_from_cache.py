@@ -60,10 +60,7 @@ def is_int(string):
         return False
 
 def add_csfs(coefs, csfs):
-    res = Vec.zero()
-    for coef, csf in zip(coefs, csfs):
-        res += coef*csf
-    return res
+    return Vec.linear_combination(coefs, csfs)
 
 def write_csf_section(qmc_cache, qmc_file, csf_tol, reduce_csfs):
     config_labels, dets = {}, []
@@ -151,7 +148,7 @@ def write_csfs(qmc_file, config_csfs, config_labels, csf_tol, reduce_csfs):
             ' (cdet_in_csf(idet_in_csf,icsf),idet_in_csf=1,ndet_in_csf(icsf))\n')
         output_lines.append(index_str)
         output_lines.append(coeff_str)
-        wf += coef*csf
+        wf.axpy(coef, csf)
     wf_energy = Ham("FCIDUMP_real_orbs").expectation(wf)
     return wf_energy, len(sorted_csfs), len(sorted_dets), output_lines
 
@@ -0,0 +1,265 @@
+'''
+L,S-adapted CSFs for atoms, built by Clebsch-Gordan coupling of shells.
+
+A shell of angular momentum l has the 2l+1 orbitals m = -l, ..., l, which
+are labelled 1, ..., 2l+1 (label = m + l + 1) and taken to follow the
+Condon-Shortley convention, L+|m> = sqrt(l(l+1) - m(m+1))|m+1>. A state is
+a dict {(up labels, dn labels): coef}, the labels sorted and the electrons
+ordered as all up electrons followed by all dn electrons (as for vec.Det).
+Angular momenta of spins are written doubled (twice_s, twice_ms) so that
+all quantum numbers are ints.
+
+shell_multiplets(l, k) gives the terms of l^k and ls_states couples the
+terms of several shells into states of definite total L, S, M_L and
+M_S = S. Both are memoized, so shells with the same l^k (and atoms with
+the same shell pattern) share their results.
+'''
+import itertools
+import math
+import numpy as np
+import scipy.linalg
+
+_multiplets = {}
+_states = {}
+_cgs = {}
+
+def half_factorial(twice_n):
+    assert(twice_n%2 == 0 and twice_n >= 0)
+    return math.factorial(twice_n//2)
+
+def clebsch_gordan(tj1, tm1, tj2, tm2, tj, tm):
+    '''<j1 m1 j2 m2|j m> (Racah's formula), all arguments doubled'''
+    key = (tj1, tm1, tj2, tm2, tj, tm)
+    if key in _cgs:
+        return _cgs[key]
+    res = 0.
+    if (tm1 + tm2 == tm and abs(tm1) <= tj1 and abs(tm2) <= tj2 and abs(tm) <= tj
+            and abs(tj1 - tj2) <= tj <= tj1 + tj2 and (tj1 + tj2 + tj)%2 == 0):
+        f = half_factorial
+        norm = math.sqrt((tj + 1)*f(tj + tj1 - tj2)*f(tj - tj1 + tj2)*f(tj1 + tj2 - tj)
+                         /f(tj1 + tj2 + tj + 2))
+        norm *= math.sqrt(f(tj + tm)*f(tj - tm)*f(tj1 - tm1)*f(tj1 + tm1)
+                          *f(tj2 - tm2)*f(tj2 + tm2))
+        total, k = 0., 0
+        while True:
+            args = (tj1 + tj2 - tj - 2*k, tj1 - tm1 - 2*k, tj2 + tm2 - 2*k,
+                    tj - tj2 + tm1 + 2*k, tj - tj1 - tm2 + 2*k)
+            if min(args[:3]) < 0:
+                break
+            if min(args[3:]) >= 0:
+                total += (-1)**k/(math.factorial(k)*np.prod([f(arg) for arg in args]))
+            k += 1
+        res = norm*total
+    _cgs[key] = res
+    return res
+
+def shell_dets(l, k):
+    '''dets of k electrons in a shell, as (up labels, dn labels)'''
+    n = 2*l + 1
+    dets = []
+    for spin_orbs in itertools.combinations(range(2*n), k):
+        dets.append((tuple(orb + 1 for orb in spin_orbs if orb < n),
+                     tuple(orb - n + 1 for orb in spin_orbs if orb >= n)))
+    return dets
+
+def hop(det, frm, to, spin):
+    '''a+_to a_frm (labels, spin 0 = up) applied to det: (new det, sign) or None'''
+    occ = det[spin]
+    if frm not in occ or (to in occ and to != frm):
+        return None
+    lo, hi = min(frm, to), max(frm, to)
+    sign = -1 if sum(lo < orb < hi for orb in occ)%2 else 1
+    new = tuple(sorted([orb for orb in occ if orb != frm] + [to]))
+    return ((new, det[1]) if spin == 0 else (det[0], new)), sign
+
+def spin_flip(det, orb, raising):
+    '''a+_{orb up} a_{orb dn} (raising) or a+_{orb dn} a_{orb up}: (new det, sign) or None'''
+    up, dn = det
+    if raising and orb in dn and orb not in up:
+        new = (tuple(sorted(up + (orb,))), tuple(o for o in dn if o != orb))
+    elif not raising and orb in up and orb not in dn:
+        new = (tuple(o for o in up if o != orb), tuple(sorted(dn + (orb,))))
+    else:
+        return None
+    #Electrons passed over in the up-then-dn ordering: the up electrons after
+    #orb and the dn electrons before it
+    passed = sum(o > orb for o in up) + sum(o < orb for o in dn)
+    return new, (-1 if passed%2 else 1)
+
+def shell_ops(l, dets):
+    '''L+, L-, S+, S- as dense matrices on the dets of a shell'''
+    index = {det: n for n, det in enumerate(dets)}
+    ops = [np.zeros((len(dets), len(dets))) for n in range(4)]
+    lp, lm, sp, sm = ops
+    for col, det in enumerate(dets):
+        for label in range(1, 2*l + 2):
+            m = label - l - 1
+            for spin in (0, 1):
+                if m < l:
+                    res = hop(det, label, label + 1, spin)
+                    if res:
+                        lp[index[res[0]], col] += res[1]*math.sqrt(l*(l+1) - m*(m+1))
+                if m > -l:
+                    res = hop(det, label, label - 1, spin)
+                    if res:
+                        lm[index[res[0]], col] += res[1]*math.sqrt(l*(l+1) - m*(m-1))
+            for op, raising in ((sp, True), (sm, False)):
+                res = spin_flip(det, label, raising)
+                if res:
+                    op[index[res[0]], col] += res[1]
+    return ops
+
+def shell_multiplets(l, k):
+    '''
+    Terms of l^k: a list of (L, twice_S, comps) with comps[(M, twice_MS)] the
+    state with those quantum numbers. Highest weight states are the common
+    null space of L+ and S+ in each (M = L, M_S = S) sector; the rest of each
+    multiplet follows by applying L- and S- (so relative phases are
+    Condon-Shortley).
+    '''
+    if (l, k) in _multiplets:
+        return _multiplets[(l, k)]
+    dets = shell_dets(l, k)
+    lp, lm, sp, sm = shell_ops(l, dets)
+    ml = np.array([sum(orb - l - 1 for orb in up + dn) for up, dn in dets])
+    twice_ms = np.array([len(up) - len(dn) for up, dn in dets])
+    res = []
+    for L, twice_s in sorted(set(zip(ml, twice_ms)), reverse = True):
+        if L < 0 or twice_s < 0:
+            continue
+        sector = np.flatnonzero((ml == L) & (twice_ms == twice_s))
+        raise_ops = np.vstack([lp[:, sector], sp[:, sector]])
+        for hw in scipy.linalg.null_space(raise_ops).T:
+            top = np.zeros(len(dets))
+            top[sector] = hw
+            comps, spin_comp = {}, top
+            for twice_ms_ in range(twice_s, -twice_s - 1, -2):
+                comp = spin_comp
+                for M in range(L, -L - 1, -1):
+                    comps[(M, twice_ms_)] = comp
+                    comp = lm.dot(comp)/math.sqrt(L*(L+1) - (M-1)*M) if M > -L else None
+                s, ms = twice_s/2., twice_ms_/2.
+                if twice_ms_ > -twice_s:
+                    spin_comp = sm.dot(spin_comp)/math.sqrt(s*(s+1) - ms*(ms-1))
+            res.append((int(L), int(twice_s), {key: to_state(dets, comp)
+                                               for key, comp in comps.items()}))
+    _multiplets[(l, k)] = res
+    return res
+
+def to_state(dets, coefs, tol = 1e-12):
+    return {det: coef for det, coef in zip(dets, coefs) if abs(coef) > tol}
+
+def shift(state, offset):
+    return {(tuple(orb + offset for orb in up), tuple(orb + offset for orb in dn)): coef
+            for (up, dn), coef in state.items()}
+
+def product(state1, state2):
+    '''
+    Antisymmetrized product of states of two different shells, the labels of
+    state2 all above those of state1
+    '''
+    res = {}
+    for (up1, dn1), coef1 in state1.items():
+        for (up2, dn2), coef2 in state2.items():
+            #Moving the up electrons of det2 past the dn electrons of det1
+            sign = -1 if (len(dn1)*len(up2))%2 else 1
+            det = (up1 + up2, dn1 + dn2)
+            res[det] = res.get(det, 0.) + sign*coef1*coef2
+    return res
+
+def couple(comps1, L1, twice_s1, comps2, L2, twice_s2, L, twice_s, keys):
+    '''Components keys = [(M, twice_MS)] of the (L, S) state coupled from two multiplets'''
+    res = {}
+    for M, twice_ms in keys:
+        state = {}
+        for (M1, twice_ms1), comp1 in comps1.items():
+            M2, twice_ms2 = M - M1, twice_ms - twice_ms1
+            if (M2, twice_ms2) not in comps2:
+                continue
+            cg = (clebsch_gordan(2*L1, 2*M1, 2*L2, 2*M2, 2*L, 2*M)
+                  *clebsch_gordan(twice_s1, twice_ms1, twice_s2, twice_ms2, twice_s, twice_ms))
+            if abs(cg) < 1e-14:
+                continue
+            for det, coef in product(comp1, comps2[(M2, twice_ms2)]).items():
+                state[det] = state.get(det, 0.) + cg*coef
+        res[(M, twice_ms)] = {det: coef for det, coef in state.items() if abs(coef) > 1e-12}
+    return res
+
+def ls_states(shells, L, twice_s, M):
+    '''
+    States with total angular momentum L, spin S = twice_s/2, M_L = M and
+    M_S = S for the shells ((l, k), ...), coupled in order. Shell n uses the
+    labels after those of shells 0, ..., n-1. Returns a list of states, one
+    per coupling path (sequence of intermediate terms) reaching (L, S).
+    '''
+    key = (tuple(shells), L, twice_s, M)
+    if key in _states:
+        return _states[key]
+    #Branches: (L, twice_S, comps) of the shells coupled so far
+    branches, offset = [(0, 0, {(0, 0): {((), ()): 1.}})], 0
+    for n, (l, k) in enumerate(shells):
+        last = n == len(shells) - 1
+        new_branches = []
+        for L1, twice_s1, comps1 in branches:
+            for L2, twice_s2, comps2 in shell_multiplets(l, k):
+                comps2 = {key: shift(comp, offset) for key, comp in comps2.items()}
+                if last:
+                    targets = [(L, twice_s)]
+                else:
+                    targets = itertools.product(
+                        range(abs(L1 - L2), L1 + L2 + 1),
+                        range(abs(twice_s1 - twice_s2), twice_s1 + twice_s2 + 1, 2))
+                for L12, twice_s12 in targets:
+                    if not (abs(L1 - L2) <= L12 <= L1 + L2 and
+                            abs(twice_s1 - twice_s2) <= twice_s12 <= twice_s1 + twice_s2 and
+                            (twice_s1 + twice_s2 - twice_s12)%2 == 0):
+                        continue
+                    keys = ([(M, twice_s)] if last else
+                            [(M12, ms12) for M12 in range(-L12, L12 + 1)
+                                         for ms12 in range(-twice_s12, twice_s12 + 1, 2)])
+                    new_branches.append((L12, twice_s12, couple(
+                        comps1, L1, twice_s1, comps2, L2, twice_s2, L12, twice_s12, keys)))
+        branches, offset = new_branches, offset + 2*l + 1
+    res = [comps[(M, twice_s)] for L_, twice_s_, comps in branches
+           if abs(M) <= L and comps[(M, twice_s)]]
+    _states[key] = res
+    return res
+
+def test_ls_states():
+    '''ls_states are L2 eigenstates with the requested L (p^2, p^3 and p d terms)'''
+    def apply_l(shells, state, raising):
+        #L+ (raising) or L- summed over the shells, with hop on the global labels
+        res, offset = {}, 0
+        for l, k in shells:
+            for label in range(1, 2*l + 2):
+                m = label - l - 1
+                if m == (l if raising else -l):
+                    continue
+                to, elem = ((label + 1, math.sqrt(l*(l+1) - m*(m+1))) if raising else
+                            (label - 1, math.sqrt(l*(l+1) - m*(m-1))))
+                for det, coef in state.items():
+                    for spin in (0, 1):
+                        hopped = hop(det, offset + label, offset + to, spin)
+                        if hopped:
+                            new, sign = hopped
+                            res[new] = res.get(new, 0.) + sign*elem*coef
+            offset += 2*l + 1
+        return res
+    cases = [(((1, 2),), 1, 2), (((1, 2),), 2, 0), (((1, 2),), 0, 0), 
+             (((1, 3),), 0, 3), (((1, 3),), 1, 1), (((1, 3),), 2, 1), 
+             (((1, 1), (2, 1)), 2, 2), (((1, 1), (2, 1)), 3, 0)]
+    for shells, L, twice_s in cases:
+        for M in range(-L, L + 1):
+            states = ls_states(shells, L, twice_s, M)
+            assert(states)
+            for state in states:
+                #L2 = L-L+ + Lz^2 + Lz
+                l2 = apply_l(shells, apply_l(shells, state, True), False)
+                for det, coef in state.items():
+                    l2[det] = l2.get(det, 0.) + (M*M + M - L*(L+1))*coef
+                norm = math.sqrt(sum(coef**2 for coef in state.values()))
+                residual = math.sqrt(sum(coef**2 for coef in l2.values()))
+                assert(norm > 0.1 and residual < 1e-10*norm)
+
+if __name__ == '__main__':
+    test_ls_states()
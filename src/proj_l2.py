@@ -3,7 +3,11 @@ import os
 import numpy as np
 import cProfile
 import itertools
+import collections
+import pickle
 from functools import reduce
+import scipy.sparse as sparse
+import scipy.linalg
 
 from pyscf import gto, scf
 
@@ -12,6 +16,8 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '../lib'))
 #sys.path.append('/home/tanderson/shci4qmc/src')
 #sys.path.append('/home/tanderson/shci4qmc/lib')
 
+import shci4qmc.src.vec as vec
+import shci4qmc.src.bits as bits
 from shci4qmc.src.vec import Det, Vec, Config
 from shci4qmc.lib.rel_parity import rel_parity_few_elec as rel_parity
 import shci4qmc.src.p2d as p2d
@@ -34,9 +40,9 @@ def get_indices(atomic_orbs):
 
 def l_ops_atomic(atomic_orbs):
     nao = len(atomic_orbs)
-    lup = np.zeros((nao, nao), dtype = np.complex64) 
-    ldn = np.zeros((nao, nao), dtype = np.complex64) 
-    lz  = np.zeros((nao, nao), dtype = np.complex64) 
+    lup = np.zeros((nao, nao), dtype = complex) 
+    ldn = np.zeros((nao, nao), dtype = complex) 
+    lz  = np.zeros((nao, nao), dtype = complex) 
     indices = get_indices(atomic_orbs)
     for n, orb in enumerate(atomic_orbs):
         n, l, m = orb.quant_nums
@@ -44,9 +50,9 @@ def l_ops_atomic(atomic_orbs):
         i = indices[(atom_id, basis_id, l, m)]
         iup = indices.get((atom_id, basis_id, l, m+1), None)
         idn = indices.get((atom_id, basis_id, l, m-1), None)
-        if iup:
+        if iup is not None:
             lup[iup, i] = np.sqrt(l*(l+1) - m*(m+1))
-        if idn:
+        if idn is not None:
             ldn[idn, i] = np.sqrt(l*(l+1) - m*(m-1))
         lz[i, i] = m
     #write in a 'sparse' format?
@@ -84,111 +90,166 @@ def atomic2mol_matrix(mo_coeffs, atomic_orbs):
 #    else:
 #        return [(coef, [orb] + expanded) for coef, expanded in others_expand]
 
-def combine_orbs(orbs):
-    coef, orb_list = 1, []
-    for orb in orbs:
-        if isinstance(orb, tuple):
-            orb_coef, orb_num = orb
-            coef *= orb_coef
-            orb_list.append(orb_num)
-        elif isinstance(orb, (int, np.int64)):
-            orb_list.append(orb)
-        else:
-            raise TypeError(
-                "Bad 'orbs' type in combine_orbs: ", type(orb), "orbs: ", orbs)
-    coef *= rel_parity(orb_list)
-    return (coef, sorted(orb_list))
-
-def expand_orbs(orbs):
-    lists = [orb if isinstance(orb, list) else [orb] for orb in orbs]
-    return [combine_orbs(orbs) for orbs in itertools.product(*lists)]
-
-def get_new_orbs(op, up_orbs, dn_orbs):
-    new_up_orbs, new_dn_orbs = [], []
-    for n, orb in enumerate(up_orbs):
-        expanded = expand_orbs(up_orbs[:n] + [op[orb]] + up_orbs[n+1:])
-        new_up_orbs += expanded
-    for n, orb in enumerate(dn_orbs):
-        expanded = expand_orbs(dn_orbs[:n] + [op[orb]] + dn_orbs[n+1:])
-        new_dn_orbs += expanded
-    return new_up_orbs, new_dn_orbs
-
-def dets_from_new_orbs(new_up_orbs, new_dn_orbs, up_orbs, dn_orbs):
-    res = Vec.zero()
-    for up_coef, up_occ in new_up_orbs:
-        res += Vec({Det(up_occ, dn_orbs): up_coef})
-#        p = rel_parity(up_occ)
-#        res += up_coef*p*Det(up_occ, dn_orbs)
-    for dn_coef, dn_occ in new_dn_orbs:
-        res += Vec({Det(up_orbs, dn_occ): dn_coef})
-#        p = rel_parity(dn_occ)
-#        res += dn_coef*p*Det(up_orbs, dn_occ)
-    return res
-    
+def csr_op(op):
+    '''
+    One-body op in sparse_rep form, {orb: [(coef, new_orb), ...]}, as a 
+    csr_matrix whose row orb-1 holds coef at column new_orb-1 (csr_matrix 
+    input is returned unchanged)
+    '''
+    if sparse.issparse(op):
+        return op
+    data, rows, cols = [], [], []
+    for orb, coefs in op.items():
+        for coef, new_orb in coefs:
+            data.append(coef)
+            rows.append(orb-1)
+            cols.append(new_orb-1)
+    n = max([len(op)] + [orb for orb in op] + [col+1 for col in cols])
+    return sparse.csr_matrix((data, (rows, cols)), shape=(n, n), dtype=complex)
+
+def pad_to_op(op, keys):
+    #Enough words per spin for every orbital the op can produce
+    n_words = max(keys.shape[1]//2, -(-op.shape[1]//bits.WORD_BITS))
+    keys = vec.pad_keys(keys, np.zeros((0, 2*n_words), dtype=np.uint64))[0]
+    return keys, n_words
+
+def apply_1body_packed(op, keys, coefs):
+    '''
+    csr_op op applied to the dets with packed keys (see vec.det_keys) and 
+    coefficients coefs. For each occupied orbital p and each entry (q, c) of 
+    row p of op, the det with p replaced by q gets c times the parity of the 
+    orbitals occupied between p and q. Returns arrays of the new keys, their 
+    coefficients (without the parity), parities and the rows of keys they 
+    came from, not yet sorted or reduced.
+    '''
+    keys, n_words = pad_to_op(op, keys)
+    new_keys, sources, elems, parities = [], [], [], []
+    for spin in range(2):
+        cols = slice(spin*n_words, (spin+1)*n_words)
+        words = keys[:, cols]
+        #Only the orbitals occupied in some det need visiting
+        occupied = bits.unpack(vec.words2bits(np.bitwise_or.reduce(words, axis=0)))
+        for p in [orb-1 for orb in occupied 
+                  if orb <= op.shape[0] and op.indptr[orb] > op.indptr[orb-1]]:
+            p_bit = vec.orb_words(p+1, n_words)
+            dets = np.flatnonzero(np.any(words & p_bit, axis=1))
+            qs = op.indices[op.indptr[p]:op.indptr[p+1]]
+            cs = op.data[op.indptr[p]:op.indptr[p+1]]
+            q_bits = vec.orb_words(qs+1, n_words)
+            lo, hi = np.minimum(qs, p) + 1, np.maximum(qs, p) + 1
+            between = vec.below_words(hi, n_words) & ~vec.below_words(lo+1, n_words)
+            #rest[k, m]: det k without p, against entry m
+            rest = (words[dets] ^ p_bit)[:, None, :]
+            allowed = ~np.any(rest & q_bits, axis=2)
+            signs = 1 - 2*(vec.popcount_words(rest & between)%2)
+            k, m = np.nonzero(allowed)
+            out = keys[dets[k]]
+            out[:, cols] = rest[k, 0] | q_bits[m]
+            new_keys.append(out)
+            sources.append(dets[k])
+            elems.append(cs[m])
+            parities.append(signs[k, m])
+    if not new_keys:
+        return keys[:0], np.zeros(0, dtype=complex), np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    sources = np.concatenate(sources)
+    return (np.concatenate(new_keys), coefs[sources]*np.concatenate(elems), 
+            np.concatenate(parities), sources)
+
+def change_basis_packed(U, keys, coefs):
+    '''
+    Dets with packed keys and coefficients coefs rewritten in a new orbital 
+    basis, orbital p becoming sum_q U[p, q] q (U a csr_op). The electrons of 
+    each det are recreated one at a time, lowest orbital first, each new 
+    orbital q getting the parity of the orbitals above q created so far. 
+    Rows are reduced after each electron. Returns the new keys and coefficients.
+    '''
+    keys, n_words = pad_to_op(U, keys)
+    made = np.zeros_like(keys)
+    for spin in range(2):
+        cols = slice(spin*n_words, (spin+1)*n_words)
+        while len(keys) and np.any(keys[:, cols]):
+            ps = vec.lowest_orbs(keys[:, cols])
+            parts = []
+            for p in np.unique(ps):
+                rows = np.flatnonzero(ps == p)
+                if p == 0:
+                    parts.append((keys[rows], made[rows], coefs[rows]))
+                    continue
+                qs = U.indices[U.indptr[p-1]:U.indptr[p]]
+                cs = U.data[U.indptr[p-1]:U.indptr[p]]
+                q_bits = vec.orb_words(qs+1, n_words)
+                above = ~vec.below_words(qs+2, n_words)
+                done = made[rows][:, None, cols]
+                allowed = ~np.any(done & q_bits, axis=2)
+                signs = 1 - 2*(vec.popcount_words(done & above)%2)
+                k, m = np.nonzero(allowed)
+                rest = keys[rows[k]]
+                rest[:, cols] ^= vec.orb_words(p, n_words)
+                new = made[rows[k]]
+                new[:, cols] |= q_bits[m]
+                parts.append((rest, new, coefs[rows[k]]*cs[m]*signs[k, m]))
+            rests, news, part_coefs = zip(*parts)
+            both, coefs = vec.canonical_keys(
+                np.hstack([np.concatenate(rests), np.concatenate(news)]), 
+                np.concatenate(part_coefs))
+            keys, made = both[:, :2*n_words], both[:, 2*n_words:]
+    return made, coefs
+
+def op_matrix(op, keys):
+    '''
+    csr_op op on the dets with packed keys, as (new_keys, mat) with new_keys 
+    sorted and unique and mat[i, j] = <new_keys[i]|op|keys[j]>
+    '''
+    new_keys, coefs, parities, sources = apply_1body_packed(op, keys, np.ones(len(keys)))
+    unique, first, inverse = np.unique(
+        vec.void_keys(new_keys), return_index = True, return_inverse = True)
+    mat = sparse.csr_matrix((coefs*parities, (inverse.ravel(), sources)), 
+                            shape = (len(first), len(keys)), dtype = complex)
+    return new_keys[first], mat
+
+def basis_index(basis, keys):
+    #Positions of keys in the sorted unique key array basis, and which are in it
+    basis, keys = vec.pad_keys(basis, keys)
+    basis_void, keys_void = vec.void_keys(basis), vec.void_keys(keys)
+    if len(basis_void) == 0:
+        return np.zeros(len(keys), dtype = int), np.zeros(len(keys), dtype = bool)
+    pos = np.minimum(np.searchsorted(basis_void, keys_void), len(basis_void) - 1)
+    return pos, basis_void[pos] == keys_void
+
+def restrict_rows(basis, row_keys, mat):
+    #mat (rows labelled by row_keys) with its rows moved to their place in basis
+    pos, found = basis_index(basis, row_keys)
+    select = sparse.csr_matrix((np.ones(found.sum()), (pos[found], np.flatnonzero(found))), 
+                               shape = (len(basis), len(row_keys)))
+    return select.dot(mat)
+
+def l2_spectrum(l2_block, overlap):
+    '''Eigenvalues of L2 in the space of some states, from csf_l2_blocks'''
+    l2_block, overlap = l2_block.toarray(), overlap.toarray()
+    return scipy.linalg.eigh((l2_block + l2_block.conj().T)/2, overlap, eigvals_only = True)
+
+def packed_state(cls, keys, coefs):
+    #Sorts and reduces the kernel output once, as a cls
+    return cls.fromvec(vec.ArrayVec.fromarrays(keys, coefs))
+
 def apply_1body(op, state):
+    '''op (sparse_rep or csr_op form) applied to a Det or Vec in one batch'''
+    op = csr_op(op)
     if isinstance(state, Det):
-        #returns a Vec/CSF after applying operator
-        up_orbs, dn_orbs = state.up_occ, state.dn_occ
-#        new_up_orbs, new_dn_orbs = [], []
-#        for n, orb in enumerate(up_orbs):
-#            expanded = expand_orbs(up_orbs[:n] + [op[orb]] + up_orbs[n+1:])
-#            new_up_orbs += expanded
-#        for n, orb in enumerate(dn_orbs):
-#            expanded = expand_orbs(dn_orbs[:n] + [op[orb]] + dn_orbs[n+1:])
-#            new_dn_orbs += expanded
-        new_up_orbs, new_dn_orbs = get_new_orbs(op, up_orbs, dn_orbs)
-        return dets_from_new_orbs(new_up_orbs, new_dn_orbs, up_orbs, dn_orbs)
-#        res = Vec.zero()
-#        for up_coef, up_occ in new_up_orbs:
-#            p = rel_parity(up_occ)
-#            res += up_coef*p*Det(up_occ, dn_orbs)
-#        for dn_coef, dn_occ in new_dn_orbs:
-#            p = rel_parity(dn_occ)
-#            res += dn_coef*p*Det(up_orbs, dn_occ)
-#        return res
+        cls, state_arrays = Vec, vec.ArrayVec({state: 1})
     elif isinstance(state, Vec):
-        res = Vec.zero()
-        for det, coef in state.dets.items():
-            res += coef*apply_1body(op, det)
-        return res
-
-def make_state(coef, up_occ, dn_occ):
-    return Vec({Det(up_occ, dn_occ): coef})
-
-#def add_det(res, up_orbs, dn_orbs, i, j):
-#    up_coef, up_occ = up_orbs[i]
-#    dn_coef, dn_occ = dn_orbs[j]
-#    res += Vec({Det(up_occ, dn_occ): up_coef*dn_coef})
-##    res += make_state(up_coef*dn_coef, up_occ, dn_occ)
-##    res += (up_coef*dn_coef)*Det(up_occ, dn_occ)
-#    return
-
-def construct_state(up_orbs, dn_orbs):
-    res = Vec.zero()
-    for i, j in np.ndindex(len(up_orbs), len(dn_orbs)):
-        up_coef, up_occ = up_orbs[i]
-        dn_coef, dn_occ = dn_orbs[j]
-        res += Vec({Det(up_occ, dn_occ): up_coef*dn_coef})
-    return res
-#    for up_orb, dn_orb in itertools.product(up_orbs, dn_orbs):
-#        up_coef, up_occ = up_orb
-#        dn_coef, dn_occ = dn_orb
-#        res += (up_coef*dn_coef)*Det(up_occ, dn_occ)
-#    for up_coef, up_occ in up_orbs:
-#        for dn_coef, dn_occ in dn_orbs:
-#            res += (up_coef*dn_coef)*Det(up_occ, dn_occ)
+        cls, state_arrays = type(state), vec.ArrayVec.fromvec(state)
+    keys, coefs, parities, sources = apply_1body_packed(
+        op, state_arrays.keys, state_arrays.coefs)
+    return packed_state(cls, keys, coefs*parities)
 
 def change_basis(U, state):
+    U = csr_op(U)
     if isinstance(state, Det):
-        up_orbs, dn_orbs = state.up_occ, state.dn_occ
-        new_up_orbs = expand_orbs([U[orb] for orb in up_orbs])
-        new_dn_orbs = expand_orbs([U[orb] for orb in dn_orbs])
-        return construct_state(new_up_orbs, new_dn_orbs)
+        cls, state_arrays = Vec, vec.ArrayVec({state: 1})
     elif isinstance(state, Vec):
-        res = Vec.zero()
-        for det, coef in state.dets.items():
-            res += coef*change_basis(U, det)
-        return res
+        cls, state_arrays = type(state), vec.ArrayVec.fromvec(state)
+    return packed_state(cls, *change_basis_packed(U, state_arrays.keys, state_arrays.coefs))
 
 def sparse_rep(matrix):
     tol = 1e-12
@@ -206,16 +267,61 @@ def convert_op(a2m, op):
     #and to sparse format
     return sparse_rep(reduce(np.matmul, (np.linalg.inv(a2m.T), op, a2m.T)))
 
+def l_masks(ang_mom):
+    '''
+    Bitmask (bit l set for each possible l) of every orbital in ang_mom, 
+    indexed by orbital. Index 0 (l = 0 only) pads rows of vec.occ_orbs.
+    '''
+    masks = np.ones(max(ang_mom) + 1, dtype=np.int64)
+    for orb, ls in ang_mom.items():
+        masks[orb] = sum(1 << l for l in ls)
+    return masks
+
+def orb_lzs(mo_coeffs_sparse, atomic_orbs):
+    '''
+    m of the aos in each mol orb, indexed by orbital, and whether that m is 
+    unique (as it should be with linear symmetry)
+    '''
+    lzs = np.zeros(max(mo_coeffs_sparse) + 1, dtype=np.int64)
+    pure = np.ones(len(lzs), dtype=bool)
+    for orb, ao_coefs in mo_coeffs_sparse.items():
+        ms = set(atomic_orbs[ao-1].m for coef, ao in ao_coefs)
+        pure[orb] = len(ms) == 1
+        lzs[orb] = min(ms)
+    return lzs, pure
+
+def ang_mom_bounds(masks, keys):
+    '''
+    Min and max possible L of the dets with packed keys, adding the l of 
+    each occupied orbital in turn: [min, max] coupled with l gives 
+    [distance from l to [min, max], max + l], minimized/maximized over the 
+    possible l of the orbital.
+    '''
+    orbs = vec.occ_orbs(keys)
+    min_l, max_l = np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=np.int64)
+    max_orb_l = int(masks.max()).bit_length() - 1
+    for orb_masks in masks[orbs.T]:
+        new_min, new_max = np.full(len(keys), np.iinfo(np.int64).max), max_l.copy()
+        for l in range(max_orb_l + 1):
+            has_l = (orb_masks >> l) & 1 == 1
+            dist = np.maximum(0, np.maximum(l - max_l, min_l - l))
+            new_min = np.where(has_l, np.minimum(new_min, dist), new_min)
+            new_max = np.where(has_l, max_l + l, new_max)
+        min_l, max_l = new_min, new_max
+    return min_l, max_l
+
+def state_keys(state):
+    #Packed keys of the dets of state, in the order of state.dets
+    if isinstance(state, vec.ArrayVec):
+        return state.keys
+    return vec.det_keys([state] if isinstance(state, Det) else list(state.dets))
+
 def apply_l2(lup, ldn, lz, csf):
-    res = Vec.zero()
     lz_csf = apply_1body(lz, csf)
     lz2_csf = apply_1body(lz, lz_csf)
     lup_csf = apply_1body(lup, csf)
     ldn_lup_csf = apply_1body(ldn, lup_csf)
-    res += ldn_lup_csf
-    res += lz2_csf
-    res += lz_csf
-    return res
+    return Vec.linear_combination([1, 1, 1], [ldn_lup_csf, lz2_csf, lz_csf])
 
 #def proj_l2(projected_out_ls, targ, lup, ldn, lz, csf):
 #    #TODO: prune small coefs?
@@ -236,21 +342,185 @@ def apply_l2(lup, ldn, lz, csf):
 #    return res
 
 def real_part(csf):
-    res = Vec.zero()
-    for det, coef in csf.dets.items():
-        res += coef.real*det
-    return res
+    return Vec.linear_combination([coef.real for coef in csf.dets.values()], csf.dets)
+
+class LRUCache:
+    '''Mapping of at most maxsize items, evicting the least recently used'''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def get(self, key, compute):
+        #Returns the cached value for key, computing it with compute() on a miss
+        if key in self.data:
+            self.hits += 1
+            self.data.move_to_end(key)
+            return self.data[key]
+        self.misses += 1
+        val = compute()
+        self.data[key] = val
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last = False)
+        return val
+
+    def update(self, items):
+        #Adds the (key, val) items as the most recently used, evicting as needed
+        for key, val in items:
+            self.data[key] = val
+            self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last = False)
+
+    def clear(self):
+        self.data.clear()
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self.data)
 
 def memoize_op(op):
-    mem = {}
+    #Caches op(p, det) in p.op_caches, one LRUCache per op and L2Projector
     def memoized(p, state):
         if isinstance(state, Det):
-            if state not in mem:
-                mem[state] = op(p, state)
-            return mem[state]
+            if op.__name__ not in p.op_caches:
+                p.op_caches[op.__name__] = LRUCache(p.op_cache_size)
+            return p.op_caches[op.__name__].get(state, lambda: op(p, state))
         return op(p, state)
     return memoized
 
+def krylov_eigencomponent(A, v, eig, tol, max_dim = 200):
+    '''
+    Component of v in the eigenspace of A with eigenvalue eig (l(l+1) values are 
+    at least 2 apart, so Ritz values within 1/2 of eig are taken to belong to it). 
+    Uses the spectral projector of A restricted to the Krylov space of v, with 
+    full reorthogonalization, growing the space until the result w satisfies 
+    |Aw - eig w|/|w| < tol or the space is invariant. Left and right Ritz vectors 
+    are used, so A needn't be exactly Hermitian. Returns (w, |Aw - eig w|/|w|); 
+    raises RuntimeError if the space reaches max_dim without meeting tol.
+    '''
+    norm = np.linalg.norm(v)
+    if norm == 0:
+        return v, 0.
+    Q, AQ = [v/norm], []
+    while True:
+        AQ.append(A.dot(Q[-1]))
+        Qm, AQm = np.array(Q).T, np.array(AQ).T
+        H = Qm.conj().T.dot(AQm)
+        thetas, left, right = scipy.linalg.eig(H, left = True, right = True)
+        #v = norm*Q e_1, so its projection is sum_i r_i (l_i^H e_1)/(l_i^H r_i)*norm
+        y = np.zeros(len(Q), dtype=complex)
+        for i in np.flatnonzero(abs(thetas - eig) < 0.5):
+            y += right[:, i]*(norm*left[0, i].conj()/left[:, i].conj().dot(right[:, i]))
+        w, Aw = Qm.dot(y), AQm.dot(y)
+        w_norm = np.linalg.norm(w)
+        err = np.linalg.norm(Aw - eig*w)/w_norm if w_norm > 0 else 0.
+        #Next basis vector
+        r = AQ[-1] - Qm.dot(Qm.conj().T.dot(AQ[-1]))
+        r -= Qm.dot(Qm.conj().T.dot(r))
+        beta = np.linalg.norm(r)
+        invariant = beta < 1e-10*np.linalg.norm(AQ[-1]) or beta == 0
+        if (w_norm > 0 and err < tol) or invariant:
+            return w, err
+        if len(Q) == max_dim:
+            raise RuntimeError('Krylov space reached max_dim = %d without converging to %.1e '
+                               '(eigen error %.3e, |w| = %.3e) in krylov_eigencomponent'% 
+                               (max_dim, tol, err, w_norm))
+        Q.append(r/beta)
+
+def relabel(state, labels):
+    '''state with orbital orb renamed labels[orb], with the sign from reordering'''
+    coefs, dets = [], []
+    for det, coef in state.dets.items():
+        up = [labels[orb] for orb in det.up_occ]
+        dn = [labels[orb] for orb in det.dn_occ]
+        coefs.append(coef*rel_parity(up)*rel_parity(dn))
+        dets.append(Det(up, dn))
+    return Vec.linear_combination(coefs, dets)
+
+def load_proj_cache(filename, settings):
+    '''
+    Projections saved by save_proj_cache, or {} if there's no file or they 
+    were made with other projection settings
+    '''
+    if filename and os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            saved = pickle.load(f)
+        if isinstance(saved, dict) and saved.get('settings') == settings:
+            return saved['cache']
+        print('Ignoring %s: made with other projection settings'% filename)
+    return {}
+
+class L2Space:
+    '''
+    The dets reachable from seeds under the projector's lz, lup and ldn, 
+    with L2 = ldn*lup + lz*lz + lz on them as a csr_matrix.
+    '''
+    def __init__(self, projector, seeds):
+        self.dets, self.index = [], {}
+        for det in seeds:
+            self.add(det)
+        ops = [projector.csr_ops[name] for name in ('lz', 'lup', 'ldn')]
+        none = np.zeros(0, dtype=int)
+        entries = [([none], [none], [none]) for op in ops]
+        n = 0
+        #breadth-first closure, a whole layer of new dets per apply_1body_packed call
+        while n < len(self.dets):
+            layer = vec.det_keys(self.dets[n:])
+            for op, (data, rows, cols) in zip(ops, entries):
+                keys, coefs, parities, sources = apply_1body_packed(
+                    op, layer, np.ones(len(layer)))
+                if len(keys) == 0:
+                    continue
+                unique, first, inverse = np.unique(
+                    vec.void_keys(keys), return_index = True, return_inverse = True)
+                new_rows = np.array([self.add(det) for det in vec.keys2dets(keys[first])])
+                data.append(coefs*parities)
+                rows.append(new_rows[inverse.ravel()])
+                cols.append(n + sources)
+            n += len(layer)
+        dim = len(self.dets)
+        lz, lup, ldn = [sparse.csr_matrix(
+            (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))), 
+            shape=(dim, dim), dtype=complex) for data, rows, cols in entries]
+        self.l2 = (ldn.dot(lup) + lz.dot(lz) + lz).tocsr()
+
+    def add(self, det):
+        if det not in self.index:
+            self.index[det] = len(self.dets)
+            self.dets.append(det)
+        return self.index[det]
+
+class L2Diagnostics:
+    '''
+    L2 diagnostics of state for target l = targ. L2 is applied to state once, 
+    on construction; the expectation value, residual and eigen error all 
+    come from that result.
+    '''
+    def __init__(self, projector, targ, state):
+        self.projector, self.targ, self.state = projector, targ, state
+        self.l2_state = projector.L2(state)
+
+    def expectation(self):
+        #<state|L2|state>
+        expec = self.state.dot(self.l2_state)
+        assert(expec.imag < 1e-12)
+        return expec.real
+
+    def residual_norm(self):
+        #|L2 state - targ(targ+1) state|
+        residual = type(self.l2_state).linear_combination(
+            [1, -self.targ*(self.targ+1)], [self.l2_state, self.state])
+        return residual.norm().real
+
+    def eigen_error(self):
+        #residual_norm()/|targ(targ+1) state|, or residual_norm()/|state| if targ = 0
+        norm = self.state.norm().real
+        if norm == 0:
+            return 0
+        eig = self.targ*(self.targ+1)
+        return self.residual_norm()/(eig*norm if eig > 0 else norm)
+
 #TEST
 class BVec:
     def __init__(self, bv_id):
@@ -264,8 +534,35 @@ class AtomicOrb:
 #TEST
 
 class L2Projector:
-    def __init__(self, mol, mf):
+    def __init__(self, mol, mf, vec_rep = 'dict', l2_rep = 'vec', op_cache_size = 100000,
+                 proj_method = 'lowdin', proj_tol = 1e-6, 
+                 proj_cache_file = None, proj_cache_size = 10000, proj_max_dim = 200):
         self.op_tol = 1e-2
+        #per-instance caches of apply_lz/lup/ldn on single dets (see memoize_op)
+        self.op_cache_size = op_cache_size
+        self.op_caches = {}
+        self.vec_type = vec.vec_type(vec_rep)
+        #'vec': apply L2 det by det with apply_1body; 'sparse': as a csr_matrix 
+        #on the det space of each set of configs (see L2Space)
+        self.l2_rep = l2_rep
+        self.l2_spaces = {}
+        #'lowdin': product of (L2 - l(l+1)) factors over the possible l (proj_det); 
+        #'lanczos': spectral projection in a Krylov space of L2 (of dimension at 
+        #most proj_max_dim), to within proj_tol
+        self.proj_method = proj_method
+        self.proj_tol = proj_tol
+        self.proj_max_dim = proj_max_dim
+        #Projected csfs by canonical shell pattern (see project_csf), at most 
+        #proj_cache_size of them, kept on disk in proj_cache_file (if given) along 
+        #with the settings they depend on. new_projections are the entries added 
+        #since the last pop_new_projections.
+        self.proj_cache_file = proj_cache_file
+        self.proj_settings = {'proj_method': proj_method, 'proj_tol': proj_tol, 
+                              'op_tol': self.op_tol, 'l2_rep': l2_rep}
+        self.proj_cache = LRUCache(proj_cache_size)
+        self.proj_cache.update(load_proj_cache(proj_cache_file, self.proj_settings).items())
+        self.new_projections = []
+        self.shells = None
         truncate = np.vectorize(lambda num : num if abs(num) > self.op_tol else 0j)
 
         self.mo_occ = mf.mo_occ
@@ -288,9 +585,14 @@ class L2Projector:
         self.lup_tot = convert_op(self.a2m_full, lup)
         self.ldn_tot = convert_op(self.a2m_full, ldn)
         self.lz_tot  = convert_op(self.a2m_full, lz)
+        #csr_matrix forms used by apply_1body
+        self.csr_ops = {name: csr_op(getattr(self, name)) for name in 
+                        ('lz', 'lup', 'ldn', 'lz_tot', 'lup_tot', 'ldn_tot')}
         self.complex_bas = sparse_rep(np.linalg.inv(self.a2m))
         self.mol_bas = sparse_rep(self.a2m)
         self.ang_mom = self.get_ang_mom()
+        self.l_masks = l_masks(self.ang_mom)
+        self.orb_lzs, self.pure_lz = orb_lzs(self.mo_coeffs_sparse, self.atomic_orbs)
 
         print('\nLZ: ')
         for orb, coefs in self.lz.items():
@@ -315,70 +617,153 @@ class L2Projector:
             print(n+1, ao)
         print("\n")
 
+    def clear_caches(self):
+        for name, cache in self.op_caches.items():
+            print('%s cache: %d hits, %d misses'% (name, cache.hits, cache.misses))
+            cache.clear()
+        self.l2_spaces = {}
+        print('proj cache: %d hits, %d misses'% (self.proj_cache.hits, self.proj_cache.misses))
+        self.save_proj_cache()
+
+    def save_proj_cache(self):
+        if self.proj_cache_file:
+            with open(self.proj_cache_file, 'wb') as f:
+                pickle.dump({'settings': self.proj_settings, 
+                             'cache': dict(self.proj_cache.data)}, f)
+
+    def pop_new_projections(self):
+        '''
+        The (key, projection) entries added to proj_cache since the last call, so 
+        ones made in a forked worker can be merged into the parent's proj_cache
+        '''
+        res, self.new_projections = self.new_projections, []
+        return res
+
+    def get_shells(self):
+        '''
+        Splits the orbitals into shells, the sets connected by lz, lup and ldn. 
+        Returns {orb: (shell, position in shell)} and a signature for each shell 
+        (the ops and ang. momenta in terms of positions in the shell); shells with 
+        equal signatures behave identically under L2.
+        '''
+        ops = (self.lz, self.lup, self.ldn)
+        parent = {orb: orb for orb in self.lz}
+        def find(orb):
+            while parent[orb] != orb:
+                orb = parent[orb]
+            return orb
+        for op in ops:
+            for orb, coefs in op.items():
+                for coef, new_orb in coefs:
+                    parent[find(new_orb)] = find(orb)
+        shell_orbs = {}
+        for orb in sorted(parent):
+            shell_orbs.setdefault(find(orb), []).append(orb)
+        shell_of, signatures = {}, {}
+        for shell, orbs in shell_orbs.items():
+            pos = {orb: n for n, orb in enumerate(orbs)}
+            shell_of.update({orb: (shell, pos[orb]) for orb in orbs})
+            signatures[shell] = tuple(
+                (tuple(sorted(self.ang_mom[orb])),) + tuple(
+                    tuple(sorted((pos[new_orb], round(coef.real, 8), round(coef.imag, 8)) 
+                                 for coef, new_orb in op[orb])) for op in ops)
+                for orb in orbs)
+        return shell_of, signatures
+
+    def canonical_labels(self, state):
+        '''
+        Relabelling of the orbitals of the shells used by state to 1, 2, ... 
+        (shell by shell, in order of their lowest orbital), and the signatures 
+        of those shells
+        '''
+        if self.shells is None:
+            self.shells = self.get_shells()
+        shell_of, signatures = self.shells
+        orbs = set()
+        for det in state.dets:
+            orbs.update(det.up_occ + det.dn_occ)
+        shells = sorted(set(shell_of[orb][0] for orb in orbs))
+        shell_start, start = {}, 1
+        for shell in shells:
+            shell_start[shell] = start
+            start += len(signatures[shell])
+        labels = {orb: shell_start[shell] + n for orb, (shell, n) in shell_of.items() 
+                  if shell in shell_start}
+        return labels, tuple(signatures[shell] for shell in shells)
+
+    def project_csf(self, targ, csf):
+        '''
+        project(targ, csf), reusing the projection of any earlier csf that is the 
+        same up to relabelling orbitals between shells with equal signatures 
+        (e.g. configs differing only in which radial shell of some l is used).
+        '''
+        labels, signatures = self.canonical_labels(csf)
+        canonical = relabel(csf, labels)
+        key = (targ, signatures, tuple(sorted(
+            (tuple(det.up_occ), tuple(det.dn_occ), round(coef.real, 10), round(coef.imag, 10))
+            for det, coef in canonical.dets.items())))
+        def compute():
+            projected = relabel(self.project(targ, csf), labels)
+            entry = [(tuple(det.up_occ), tuple(det.dn_occ), coef) 
+                     for det, coef in projected.dets.items()]
+            self.new_projections.append((key, entry))
+            return entry
+        inverse = {label: orb for orb, label in labels.items()}
+        projected = Vec({Det(up, dn): coef for up, dn, coef in self.proj_cache.get(key, compute)})
+        return self.vec_type.fromvec(relabel(projected, inverse))
+
     def hf_lz(self):
-        res = 0
-        for mo, occ in enumerate(self.mo_occ):
-            ao_lz = set(self.atomic_orbs[ao-1].m for coef, ao in self.mo_coeffs_sparse[mo+1])
-            assert(len(ao_lz) == 1)
-            res += int(round(occ))*ao_lz.pop()
+        occs = np.rint(self.mo_occ).astype(int)
+        assert(np.all(self.pure_lz[1:][occs > 0]))
+        res = int(occs.dot(self.orb_lzs[1:]))
         print('occ: ', self.mo_occ)
         print('lz: ', res)
         return res
             
     def lz_of(self, state):
         assert(isinstance(state, Det))
-        res = 0
-        for orb in state.up_occ:
-            lzs = set(self.atomic_orbs[ao-1].m for coef, ao in self.mo_coeffs_sparse[orb])
-            #With linear symmetry, mol orbs should be comprised of aos with equal lz vals
-            assert(len(lzs) == 1)
-            res += lzs.pop()
-        for orb in state.dn_occ:
-            lzs = set(self.atomic_orbs[ao-1].m for coef, ao in self.mo_coeffs_sparse[orb])
-            #With linear symmetry, mol orbs should be comprised of aos with equal lz vals
-            assert(len(lzs) == 1)
-            res += lzs.pop()
-        return res
+        return self.lz_values(vec.det_keys([state]))[0]
+
+    def lz_values(self, keys):
+        '''Lz of each det with packed keys'''
+        orbs = vec.occ_orbs(keys)
+        #With linear symmetry, mol orbs should be comprised of aos with equal lz vals
+        assert(np.all(self.pure_lz[orbs]))
+        return self.orb_lzs[orbs].sum(axis=1)
 
     @memoize_op
     def apply_lz(self, state):
-        return apply_1body(self.lz, state)
+        return apply_1body(self.csr_ops['lz'], state)
 
     @memoize_op
     def apply_ldn(self, state):
-        return apply_1body(self.ldn, state)
+        return apply_1body(self.csr_ops['ldn'], state)
         
     @memoize_op
     def apply_lup(self, state):
-        return apply_1body(self.lup, state)
+        return apply_1body(self.csr_ops['lup'], state)
 
     def apply_l2(self, state):
         lz_state = self.apply_lz(state)
         lz2_state = self.apply_lz(lz_state)
         lup_state = self.apply_lup(state)
         ldn_lup_state = self.apply_ldn(lup_state)
-        res = Vec.zero()
-        res += ldn_lup_state
-        res += lz2_state
-        res += lz_state
-        return res
+        return self.vec_type.linear_combination(
+            [1, 1, 1], [ldn_lup_state, lz2_state, lz_state])
 
     def L2(self, state):
-        lz_state = apply_1body(self.lz_tot, state)
-        lz2_state = apply_1body(self.lz_tot, lz_state)
-        lup_state = apply_1body(self.lup_tot, state)
-        ldn_lup_state = apply_1body(self.ldn_tot, lup_state)
-        res = Vec.zero()
-        res += ldn_lup_state
-        res += lz2_state
-        res += lz_state
-        return res
+        lz_state = apply_1body(self.csr_ops['lz_tot'], state)
+        lz2_state = apply_1body(self.csr_ops['lz_tot'], lz_state)
+        lup_state = apply_1body(self.csr_ops['lup_tot'], state)
+        ldn_lup_state = apply_1body(self.csr_ops['ldn_tot'], lup_state)
+        return self.vec_type.linear_combination(
+            [1, 1, 1], [ldn_lup_state, lz2_state, lz_state])
+
+    def diagnostics(self, targ, state):
+        return L2Diagnostics(self, targ, state)
 
     def L2_expectation(self, state):
-        l2_state = self.L2(state)
-        expec = state.dot(l2_state)
-        assert(expec.imag < 1e-12)
-        return expec.real 
+        return self.diagnostics(0, state).expectation()
 
     def get_ang_mom(self):
         ang_mom = {}
@@ -390,67 +775,131 @@ class L2Projector:
 
     def possible_ang_mom(self, det):
         assert(isinstance(det, Det))
-        def update_min_l(min_l, max_l, l):
-            if l > max_l:
-                return l - max_l 
-            elif l < min_l:
-                return min_l - l
-            else:
-                return 0
-        min_l, max_l = 0, 0
-        occs = det.up_occ + det.dn_occ
-        for orb in occs:
-            ls = self.ang_mom[orb]
-            min_l = min([update_min_l(min_l, max_l, l) for l in ls])
-            max_l = max_l + max(ls)
-        return [l for l in range(min_l, max_l+1)]
+        min_l, max_l = ang_mom_bounds(self.l_masks, vec.det_keys([det]))
+        return [l for l in range(min_l[0], max_l[0]+1)]
+
+    def projected_out_ls(self, targ, state):
+        '''
+        The l != targ possible for each det of state (in the order of 
+        state.dets), i.e. the factors proj_det needs. Empty for dets whose 
+        bounds are already targ, which need no projection.
+        '''
+        min_ls, max_ls = ang_mom_bounds(self.l_masks, state_keys(state))
+        return [tuple(l for l in range(min_l, max_l+1) if l != targ) 
+                for min_l, max_l in zip(min_ls, max_ls)]
     
     def pretty_print(self, state):
         for det, coef in sorted(state.dets.items(), key = lambda item: -abs(item[1])):
             print(det, ": ", coef)
 
     def project(self, targ, state):
+        if self.proj_method == 'lanczos':
+            return self.project_lanczos(targ, state)
+        elif self.proj_method != 'lowdin':
+            raise Exception('Unknown proj method \'' + self.proj_method + '\' in project')
+        if self.l2_rep == 'sparse':
+            return self.project_sparse(targ, state)
+        elif self.l2_rep != 'vec':
+            raise Exception('Unknown l2 rep \'' + self.l2_rep + '\' in project')
         if isinstance(state, Det):
             return self.proj_det(targ, state)
-        res = Vec.zero()
-        for det, coef in state.dets.items():
-            res += coef*self.proj_det(targ, det)
+        projected = [self.proj_det(targ, det, ls) if ls else det 
+                     for det, ls in zip(state.dets, self.projected_out_ls(targ, state))]
+        res = self.vec_type.linear_combination(list(state.dets.values()), projected)
         #res = self.prune(targ, res, 1e-8)
         res = self.real_coeffs(res)
         return res
 
-    def proj_det(self, targ, state):
+    def proj_det(self, targ, state, projected_out_ls = None):
         #TODO: Change proj to iterate over every det in state and add results
         assert(isinstance(state, Det))
-        projected_out_ls = [l for l in self.possible_ang_mom(state) if l != targ]
-        res = Vec.zero()
+        if projected_out_ls is None:
+            projected_out_ls = self.projected_out_ls(targ, state)[0]
+        res = self.vec_type.zero()
         res += state
         #OP IN COMPLEX BAS
         #res = change_basis(self.complex_bas, res)
         for l in projected_out_ls:
 #            print("Projecting l = ", l, " with ", len(res.dets), " dets.")
             l2_state = self.apply_l2(res)
-            res *= -l*(l+1)
-            res += l2_state
-            res /= (targ*(targ+1) - l*(l+1))
+            #res = (L2 - l(l+1))res/(targ(targ+1) - l(l+1))
+            denom = targ*(targ+1) - l*(l+1)
+            res = self.vec_type.linear_combination(
+                [-l*(l+1)/denom, 1/denom], [res, l2_state])
             #Prune res s.t. some percentage of total magnitude is present
 #            print("Ndets before prune: ", len(res.dets))
 #            res = self.prune(targ, res, 1e-8)
 #            print("Ndets after prune: ", len(res.dets))
-            remove = []
-            for det, coef in res.dets.items():
-                if abs(coef) < 1e-8:
-                    remove.append(det)
-            for det in remove:
-                del res.dets[det]
+            res.drop_small(1e-8)
         #OP IN COMPLEX BAS
         #res = change_basis(self.mol_bas, res)
         return res
 
+    def l2_space(self, dets):
+        '''
+        L2Space containing dets, shared by all states built from the same 
+        configs (extended if some of dets aren't in it yet)
+        '''
+        key = frozenset(Config(det) for det in dets)
+        space = self.l2_spaces.get(key)
+        if space is None or any(det not in space.index for det in dets):
+            seeds = list(dets) if space is None else space.dets + list(dets)
+            space = L2Space(self, seeds)
+            self.l2_spaces[key] = space
+        return space
+
+    def project_sparse(self, targ, state):
+        '''
+        project() using sparse mat-vecs with L2Space.l2. Dets needing the same 
+        sequence of factors are projected together as the columns of one matrix.
+        '''
+        is_det = isinstance(state, Det)
+        if is_det:
+            state = Vec({state: 1})
+        dets, coefs = list(state.dets), np.array(list(state.dets.values()))
+        space = self.l2_space(dets)
+        groups = {}
+        for n, ls in enumerate(self.projected_out_ls(targ, state)):
+            groups.setdefault(ls, []).append(n)
+        res = np.zeros(len(space.dets), dtype=complex)
+        for projected_out_ls, group in groups.items():
+            cols = np.zeros((len(space.dets), len(group)), dtype=complex)
+            cols[[space.index[dets[n]] for n in group], np.arange(len(group))] = 1
+            for l in projected_out_ls:
+                cols = (space.l2.dot(cols) - l*(l+1)*cols)/(targ*(targ+1) - l*(l+1))
+                cols[abs(cols) < 1e-8] = 0
+            res += cols.dot(coefs[group])
+        res = self.vec_type.linear_combination(res[res != 0], 
+                                               [space.dets[n] for n in np.flatnonzero(res)])
+        return res if is_det else self.real_coeffs(res)
+
+    def project_lanczos(self, targ, state):
+        '''
+        Component of state with L2 = targ(targ+1), found with krylov_eigencomponent 
+        on the L2Space of its dets. The number of L2 applications depends on 
+        the number of distinct l present in state, not on the range of possible l.
+        '''
+        is_det = isinstance(state, Det)
+        if is_det:
+            state = Vec({state: 1})
+        space = self.l2_space(list(state.dets))
+        v = np.zeros(len(space.dets), dtype=complex)
+        for det, coef in state.dets.items():
+            v[space.index[det]] = coef
+        res, err = krylov_eigencomponent(space.l2, v, targ*(targ+1), self.proj_tol, 
+                                         self.proj_max_dim)
+        if err > self.proj_tol:
+            #Only possible if the Krylov space became invariant (see krylov_eigencomponent)
+            print('Warning: Lanczos projection stopped with eigen error %.3e'% err)
+        res[abs(res) < 1e-8] = 0
+        res = self.vec_type.linear_combination(res[res != 0], 
+                                               [space.dets[n] for n in np.flatnonzero(res)])
+        return res if is_det else self.real_coeffs(res)
+
     def prune(self, targ, state, err):
         assert(0 < err and err < 1)
         tol = (1 - err)*state.norm()
-        res = Vec.zero()
+        res = self.vec_type.zero()
         for det, coef in sorted(state.dets.items(), key = lambda item: -abs(item[1])):
             if res.norm() > tol:
                 break
@@ -460,11 +909,10 @@ class L2Projector:
         return res
 
     def real_coeffs(self, state):
-        real = Vec.zero()
-        err = 0
-        for det, coef in state.dets.items():
-            err += abs(coef.imag)
-            real += det*(coef.real)
+        coefs = list(state.dets.values())
+        err = sum(abs(coef.imag) for coef in coefs)
+        real = self.vec_type.linear_combination(
+            [coef.real for coef in coefs], list(state.dets))
         if (err > 1e-2):
             print('\n', 'Warning: imag. part of complex coef discarded in L2 projection')
         return real
@@ -474,11 +922,7 @@ class L2Projector:
         #If targ = 0, calculate |L2(res)|
         if (state.norm() == 0):
             return 0
-        err_vec = self.L2(state)
-        err_aux = targ*(targ+1)*state
-        err_vec += -1*err_aux
-        err = err_vec.norm()/err_aux.norm() if err_aux.norm() > 0 else err_vec.norm()/state.norm()
-        return abs(err)
+        return abs(self.diagnostics(targ, state).eigen_error())
 
     def debug_proj(self, state):
         float_format = "%12.8f"
@@ -522,25 +966,58 @@ class L2Projector:
             print(det, (float_format + float_format + "i")%(coef.real, coef.imag))
         print('END DEBUG: ')
 
+    def csf_l2_blocks(self, states):
+        '''
+        <state_i|L2|state_j> and <state_i|state_j> as sparse matrices, computed 
+        as conj(C) L2 C^T with C the state-by-det coefficient matrix and L2 (the 
+        apply_l2 operators) on the dets of states
+        '''
+        arrays = [vec.ArrayVec.fromvec(state) for state in states]
+        ops = [self.csr_ops[name] for name in ('lz', 'lup', 'ldn')]
+        #Dets of all states, sorted and unique, padded for the ops
+        all_keys = pad_to_op(ops[0], np.concatenate(vec.pad_keys(
+            *[array.keys for array in arrays])))[0]
+        basis = all_keys[np.unique(vec.void_keys(all_keys), return_index = True)[1]]
+        rows = np.repeat(np.arange(len(arrays)), [len(array.coefs) for array in arrays])
+        cols = basis_index(basis, all_keys)[0]
+        coefs = np.concatenate([array.coefs for array in arrays])
+        C = sparse.csr_matrix((coefs, (rows, cols)), 
+                              shape = (len(states), len(basis)), dtype = complex)
+        (lz_keys, lz), (lup_keys, lup) = [op_matrix(op, basis) for op in ops[:2]]
+        lz_lz = op_matrix(ops[0], lz_keys)
+        ldn_lup = op_matrix(ops[2], lup_keys)
+        l2 = (restrict_rows(basis, *ldn_lup).dot(lup) + restrict_rows(basis, *lz_lz).dot(lz) 
+              + restrict_rows(basis, lz_keys, lz))
+        return C.conj().dot(l2).dot(C.T), C.conj().dot(C.T)
+
     def L2_matrix(self, states):
-        mat = np.zeros((len(states), len(states)))
-        for i, state1 in enumerate(states):
-            l2state = self.apply_l2(state1)
-            for j, state2 in enumerate(states):
-                if j <= i:
-                    mat[j][i] = state2.dot(l2state)
-                    mat[i][j] = np.conj(mat[j][i])
-        return mat
+        #mat[i][j] = <state_i|L2|state_j> (real part)
+        l2_block, overlap = self.csf_l2_blocks(states)
+        return l2_block.toarray().real
+
+    def L2_spectrum(self, states):
+        return l2_spectrum(*self.csf_l2_blocks(states))
 
 class AndreProjector():
-    def __init__(self, mol, mf):
+    def __init__(self, mol, mf, backend = 'andre'):
         self.atomic_orbs = p2d.mol2aos(mol, mf, None)
         self.mo_coeffs = p2d.aos2mo_coeffs(self.atomic_orbs)
         self.a2m = atomic2mol_matrix(self.mo_coeffs, self.atomic_orbs)
         self.op_tol = 1e-8
+        #'andre': project with lib/andre objects (independent of the L2Projector 
+        #kernels, so the default for cross-checks); 'int': the same algorithm on 
+        #integer orbital indices, with csr_matrix basis changes and L ops
+        self.backend = backend
+        #Basis changes (rows: old orbital) and complex atomic L ops, as csr_ops
+        self.ao_csr = sparse.csr_matrix(self.a2m)
+        self.mo_csr = sparse.csr_matrix(np.linalg.inv(self.a2m))
+        lup, ldn, lz = l_ops_atomic(self.atomic_orbs)
+        self.lup_csr, self.ldn_csr, self.lz_csr = [
+            sparse.csr_matrix(op.T, dtype=complex) for op in (lup, ldn, lz)]
 
         self.mo_coeffs_sparse = sparse_rep(self.mo_coeffs.T)
         self.ang_mom = self.get_ang_mom()
+        self.l_masks = l_masks(self.ang_mom)
 
         self.l_chars = {0: 'S', 1: 'P', 2: 'D', 3: 'F', 4: 'G', 5: 'H'}  
         self.up_mos, self.dn_mos = self.get_mos()
@@ -625,24 +1102,12 @@ class AndreProjector():
 #        if isinstance(config, Det):
 #            return self.possible_ang_mom(Config(config))
         assert(isinstance(det, Det))
-        def update_min_l(min_l, max_l, l):
-            if l > max_l:
-                return l - max_l 
-            elif l < min_l:
-                return min_l - l
-            else:
-                return 0
-        min_l, max_l = 0, 0
-        occs = det.up_occ + det.dn_occ
-        for orb in occs:
-            ls = self.ang_mom[orb]
-            min_l = min([update_min_l(min_l, max_l, l) for l in ls])
-            max_l = max_l + max(ls)
-        return min_l, max_l
+        min_l, max_l = ang_mom_bounds(self.l_masks, vec.det_keys([det]))
+        return min_l[0], max_l[0]
 
     def get_wrong_ang_mom(self, target, state):
-        min_l = min([self.possible_ang_mom(det)[0] for det in state.dets])
-        max_l = max([self.possible_ang_mom(det)[1] for det in state.dets])
+        min_ls, max_ls = ang_mom_bounds(self.l_masks, state_keys(state))
+        min_l, max_l = min_ls.min(), max_ls.max()
         assert(min_l <= target and target <= max_l)
         return [l for l in range(min_l, max_l+1) if l != target]
 
@@ -685,7 +1150,7 @@ class AndreProjector():
             res = Vec.zero() 
             for det, coef in state.det_coeffs.items():
                 p, converted_det = self.convert_vec(det)
-                res += coef * p * converted_det
+                res.axpy(coef * p, converted_det)
             return res
         elif isinstance(state, Determinant):
             up_orbs, dn_orbs = [], []
@@ -697,6 +1162,10 @@ class AndreProjector():
             return p, Det(up_orbs, dn_orbs)
 
     def proj(self, target, state):
+        if self.backend == 'int':
+            return self.proj_int(target, state)
+        elif self.backend != 'andre':
+            raise ValueError('Unknown backend \'' + self.backend + '\' in AndreProjector')
         assert(isinstance(state, Vec))
         wrong_ang_mom = self.get_wrong_ang_mom(target, state)
         #build det_lin_comb object
@@ -708,6 +1177,70 @@ class AndreProjector():
         projected.change_basis(self.mo_basis)
         return self.convert_vec(projected)
 
+    def proj_int(self, target, state):
+        '''proj (project_ang_mom, then normalize) on packed dets of orbital indices'''
+        assert(isinstance(state, Vec))
+        wrong_ang_mom = self.get_wrong_ang_mom(target, state)
+        #change basis to complex atomic orbitals
+        res = change_basis(self.ao_csr, vec.ArrayVec.fromvec(state))
+        for l in wrong_ang_mom:
+            lz_res = apply_1body(self.lz_csr, res)
+            ldn_lup_res = apply_1body(self.ldn_csr, apply_1body(self.lup_csr, res))
+            res = vec.ArrayVec.linear_combination(
+                [1, 1, 1, -l*(l+1)], [ldn_lup_res, apply_1body(self.lz_csr, lz_res), lz_res, res])
+        if wrong_ang_mom and res.norm() > 0:
+            res *= 1/res.norm()
+        #change basis to molecular orbitals; drop coefs below lib/andre's tol
+        res = Vec.fromvec(change_basis(self.mo_csr, res))
+        res.drop_small(1e-12)
+        return res
+
+def test_andre_backends():
+    '''AndreProjector gives the same projection with the 'int' and 'andre' backends'''
+    mol = gto.M(atom = 'C 0 0 0', basis = 'ccpvdz', spin = 2, symmetry = 'dooh', 
+                unit = 'bohr', verbose = 0)
+    mol.is_atomic_system = True
+    mf = sym_rhf.RHF(mol).run()
+    andre = AndreProjector(mol, mf, backend = 'andre')
+    intp = AndreProjector(mol, mf, backend = 'int')
+    #1s2 2s2 with two open p, or one open p and one open d
+    state = Vec({Det([1, 2, 3, 4], [1, 2]): 1., Det([1, 2, 3, 14], [1, 2]): 0.5, 
+                 Det([1, 2, 4, 6], [1, 2]): -0.25})
+    for targ in (1, 2):
+        res_andre, res_int = andre.proj(targ, state), intp.proj(targ, state)
+        diff = Vec.zero()
+        diff += res_andre
+        diff.axpy(-1, res_int)
+        assert(res_andre.norm() > 0.1)
+        assert(diff.norm() < 1e-8)
+
+def test_proj_cache_remap():
+    '''project_csf of a csf on other radial shells (a cache hit) equals project'''
+    mol = gto.M(atom = 'C 0 0 0', basis = 'ccpvdz', spin = 2, symmetry = 'dooh', 
+                unit = 'bohr', verbose = 0)
+    mol.is_atomic_system = True
+    mf = sym_rhf.RHF(mol).run()
+    p = L2Projector(mol, mf)
+    shell_of, signatures = p.get_shells()
+    #The first two p shells of cc-pVDZ carbon
+    p_shells = sorted(set(shell for shell, sig in signatures.items() 
+                          if len(sig) == 3 and sig[0][0] == (1,)))[:2]
+    (a1, b1), (a2, b2) = [[orb for orb, (shell, n) in sorted(shell_of.items()) 
+                           if shell == p_shell and n != 1] for p_shell in p_shells]
+    #p^2 closed shells, with L = 0 and L = 2 components
+    csf1 = Vec({Det([1, 2, a1], [1, 2, a1]): 1., Det([1, 2, b1], [1, 2, b1]): 0.5})
+    csf2 = Vec({Det([1, 2, a2], [1, 2, a2]): 1., Det([1, 2, b2], [1, 2, b2]): 0.5})
+    for targ in (0, 2):
+        p.project_csf(targ, csf1)
+        hits = p.proj_cache.hits
+        cached = p.project_csf(targ, csf2)
+        assert(p.proj_cache.hits == hits + 1)
+        diff = Vec.zero()
+        diff += cached
+        diff.axpy(-1, p.project(targ, csf2))
+        assert(cached.norm() > 0.1)
+        assert(diff.norm() < 1e-8)
+
 def main():
     mol = gto.Mole()
     mol.unit = 'bohr'
@@ -245,17 +245,9 @@ class CacheMaker(SymMethods, GenMethods, CsfMethods):
 
     def make_real2complex_coeffs(self):
         mo_coeff = self.mf.mo_coeff
-        h1 = reduce(
-            numpy.dot, 
-            (mo_coeff.T, self.mf.get_hcore(), mo_coeff))
-        if self.mf._eri is None:
-            eri = ao2mo.full(self.mol, mo_coeff)
-        else:
-            eri = ao2mo.full(self.mf._eri, mo_coeff)
-        nuc = self.mf.energy_nuc()
         orbsym = getattr(mo_coeff, 'orbsym', None) 
         self.get_real2complex_coeffs(
-            h1, eri, h1.shape[0], self.n_up + self.n_down, nuc, orbsym, self.partner_orbs)
+            mo_coeff.shape[1], self.n_up + self.n_down, orbsym, self.partner_orbs)
 
     def make_fcidump(self, filename):
         mo_coeff = self.mf.mo_coeff
@@ -269,6 +261,8 @@ class CacheMaker(SymMethods, GenMethods, CsfMethods):
         nuc = self.mf.energy_nuc()
         orbsym = getattr(mo_coeff, 'orbsym', None) 
         if self.symmetry in ('DOOH', 'COOV'):
+            #Keep only the 8-fold packed eri (write_complex_fcidump works on its slabs)
+            eri = ao2mo.restore(8, eri, h1.shape[0])
             self.writeComplexOrbIntegrals(
                 h1, eri, h1.shape[0], self.n_up + self.n_down, nuc, orbsym, self.partner_orbs)
             fcidump.from_integrals(
@@ -282,7 +276,7 @@ class CacheMaker(SymMethods, GenMethods, CsfMethods):
     def test_fcidump(self, filename):
         mo_coeff = self.mf.mo_coeff
         orbsym = getattr(mo_coeff, 'orbsym', None) 
-        mo_coeff = reduce(numpy.dot, (mo_coeff, self.real2complex_coeffs.conj().T))
+        mo_coeff = self.real2complex_coeffs.dot(mo_coeff.conj().T).conj().T
         h1 = reduce(numpy.dot, (mo_coeff.conj().T, self.mf.get_hcore(), mo_coeff))
         if self.mf._eri is None:
             eri = ao2mo.full(self.mol, mo_coeff)
@@ -386,7 +380,7 @@ class CacheMaker(SymMethods, GenMethods, CsfMethods):
         self.rotation_matrix = numpy.array(self.rotation_matrix).T
         if self.symmetry in ('DOOH', 'COOV'):
             R = self.real2complex_coeffs
-            self.rotation_matrix = reduce(numpy.dot, (R.conj().T, self.rotation_matrix, R)).real
+            self.rotation_matrix = R.unrotate(self.rotation_matrix).real
 
     #OUTPUT SHCI DATA
     #----------------
@@ -0,0 +1,76 @@
+'''
+Genealogical (branching diagram) spin eigenfunctions for n open shells.
+
+Replaces the spin_csf_gen executable: csf_block(n, twice_s) returns the same
+(coefs, det_strs) block that spin_csf_gen printed for N = n, S = twice_s/2,
+i.e. the M_S = S member of each spin eigenfunction, written in terms of the
+open-shell dets det_strs ('1' = up electron, '0' = dn electron, in
+lexicographic order) and including the sign from reordering the electrons
+as all up electrons followed by all dn electrons.
+'''
+import itertools
+import numpy as np
+
+_paths = {}
+_blocks = {}
+
+def branching_paths(n, twice_s):
+    '''
+    Paths through the branching diagram ending at (n, twice_s), as tuples of
+    the intermediate 2S values. Paths through S - 1/2 come before paths
+    through S + 1/2 (the ordering of spin_csf_gen).
+    '''
+    if twice_s < 0 or twice_s > n:
+        return []
+    if n == 0:
+        return [()]
+    if (n, twice_s) not in _paths:
+        _paths[(n, twice_s)] = (
+            [path + (twice_s,) for path in branching_paths(n-1, twice_s-1)] +
+            [path + (twice_s,) for path in branching_paths(n-1, twice_s+1)])
+    return _paths[(n, twice_s)]
+
+def open_shell_dets(n, nup):
+    '''bool array occ[det, k] (electron k is up) over det strings in lexicographic order'''
+    combs = list(itertools.combinations(range(n), nup))
+    ups = np.array(combs, dtype=int).reshape(len(combs), nup)
+    occ = np.zeros((len(ups), n), dtype=bool)
+    occ[np.arange(len(ups))[:, None], ups] = True
+    #Lexicographic order of the strings = numerical order reading them as binary
+    keys = occ.dot(1 << np.arange(n-1, -1, -1, dtype=np.int64))
+    return occ[np.argsort(keys, kind='stable')]
+
+def perm_factors(occ):
+    '''(-1)^(number of (dn, up) pairs with the up electron after the dn electron)'''
+    ups_after = np.cumsum(occ[:, ::-1], axis=1)[:, ::-1] - occ
+    n_swaps = np.sum(ups_after*(~occ), axis=1)
+    return np.where(n_swaps%2, -1., 1.)
+
+def csf_block(n, twice_s):
+    '''
+    Spin eigenfunctions with n open shells and spin S = twice_s/2, M_S = S.
+    Returns (coefs, det_strs) with coefs[i, j] the coefficient of det_strs[j]
+    in the i'th eigenfunction.
+    '''
+    if (n, twice_s) in _blocks:
+        return _blocks[(n, twice_s)]
+    assert((n + twice_s)%2 == 0)
+    occ = open_shell_dets(n, (n + twice_s)//2)
+    paths = branching_paths(n, twice_s)
+    paths = np.array(paths, dtype=float).reshape(len(paths), n)
+    twice_m = np.cumsum(np.where(occ, 1, -1), axis=1)
+    coefs = np.ones((len(paths), len(occ)))
+    for k in range(n):
+        #Couple electron k to the spin s of electrons 0..k-1, giving (S, M)
+        s = (paths[:, k-1] if k else np.zeros(len(paths)))[:, None]/2.
+        S = paths[:, k][:, None]/2.
+        M = twice_m[:, k][None, :]/2.
+        up = occ[:, k][None, :]
+        plus = np.sqrt(np.maximum(s + M + 0.5, 0)/(2*s + 1))
+        minus = np.sqrt(np.maximum(s - M + 0.5, 0)/(2*s + 1))
+        factor = np.where(S > s, np.where(up, plus, minus), np.where(up, -minus, plus))
+        coefs *= np.where(abs(M) <= S, factor, 0.)
+    coefs *= perm_factors(occ)[None, :]
+    det_strs = [''.join('1' if is_up else '0' for is_up in row) for row in occ]
+    _blocks[(n, twice_s)] = (coefs, det_strs)
+    return coefs, det_strs
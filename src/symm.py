@@ -1,40 +1,126 @@
 import numpy
-import ctypes
+import scipy.sparse as sparse
 import math
-from functools import reduce
 #import sys, os
 #sys.path.append(os.path.join(os.path.dirname(__file__), '../lib'))
 
 from shci4qmc.lib.rel_parity import rel_parity
 import shci4qmc.src.vec as vec
 
-import pyscf
 from pyscf import symm
-from pyscf.lib import load_library
-
-ndpointer = numpy.ctypeslib.ndpointer
-shci_lib = load_library('libshciscf')
-
-transformComplex = shci_lib.transformDinfh
-transformComplex.restyp = None
-transformComplex.argtypes = [
-    ctypes.c_int,
-    ndpointer(ctypes.c_int32),
-    ndpointer(ctypes.c_int32),
-    ndpointer(ctypes.c_double),
-    ndpointer(ctypes.c_double),
-    ndpointer(ctypes.c_double)
-]
-
-writeIntNoSymm = shci_lib.writeIntNoSymm
-writeIntNoSymm.argtypes = [
-    ctypes.c_int,
-    ndpointer(ctypes.c_double),
-    ndpointer(ctypes.c_double), 
-    ctypes.c_double, 
-    ctypes.c_int,
-    ndpointer(ctypes.c_int32)
-]
+
+def index_strings(strings):
+    '''Index of each string (orbs) among the unique strings, in order of first appearance'''
+    ids, unique = {}, []
+    for orbs in strings:
+        key = tuple(orbs)
+        if key not in ids:
+            ids[key] = len(unique)
+            unique.append(orbs)
+    return numpy.array([ids[tuple(orbs)] for orbs in strings], dtype=numpy.int64), unique
+
+def eri_slab(eri, norb, a, b):
+    '''(ab|cd) for all c, d as a norb x norb array, from eri packed 8-fold, 4-fold or not'''
+    if eri.ndim == 4:
+        return eri[a, b]
+    tril = numpy.tril_indices(norb)
+    pair = max(a, b)*(max(a, b) + 1)//2 + min(a, b)
+    if eri.ndim == 2:
+        row = eri[pair]
+    else:
+        pairs = numpy.arange(len(tril[0]))
+        hi, lo = numpy.maximum(pair, pairs), numpy.minimum(pair, pairs)
+        row = eri[hi*(hi + 1)//2 + lo]
+    slab = numpy.zeros((norb, norb))
+    slab[tril] = row
+    slab.T[tril] = row
+    return slab
+
+class Real2Complex():
+    '''
+    Real to complex orbital transform C (rows: complex orbs, cols: real orbs), 
+    block diagonal up to a permutation: row i has diag[i] at col i and 
+    offdiag[i] at col partner[i] (partner[i] = i, offdiag[i] = 0 for orbs 
+    without a partner). Products with n x n matrices are O(n^2).
+    '''
+    def __init__(self, diag, offdiag, partner):
+        self.diag, self.offdiag, self.partner = diag, offdiag, partner
+
+    def dot(self, M):
+        '''C M'''
+        return self.diag[:, None]*M + self.offdiag[:, None]*M[self.partner]
+
+    def hdot(self, M):
+        '''C^H M'''
+        return (self.diag.conj()[:, None]*M 
+                + self.offdiag[self.partner].conj()[:, None]*M[self.partner])
+
+    def rotate(self, M):
+        '''C M C^H'''
+        return self.dot(self.dot(M.conj().T).conj().T)
+
+    def unrotate(self, M):
+        '''C^H M C'''
+        return self.hdot(self.hdot(M.conj().T).conj().T)
+
+    def tocsr(self):
+        norb = len(self.diag)
+        rows = numpy.concatenate([numpy.arange(norb)]*2)
+        cols = numpy.concatenate([numpy.arange(norb), self.partner])
+        data = numpy.concatenate([self.diag, self.offdiag])
+        keep = data != 0
+        return sparse.csr_matrix((data[keep], (rows[keep], cols[keep])), shape=(norb, norb))
+
+    def toarray(self):
+        return self.tocsr().toarray()
+
+def write_complex_fcidump(filename, h1, eri, coeffs, ecore, nelec, orbsym, tol=1e-9):
+    '''
+    Writes the FCIDUMP (in the NoSymm format of writeIntNoSymm from libshciscf) 
+    of the complex orbitals with coeffs (a Real2Complex) in the real ones. 
+    h1 is already in the complex orbitals and eri is in the real ones, packed 
+    or not. Each slab (ij|..) = Re(sum conj(c_ia) c_jb conj(c_kc) c_ld (ab|cd)) 
+    is built from the slabs of the (at most 4) real pairs (ab) it needs and 
+    written straight away, so no n^4 array is made.
+    '''
+    norb = h1.shape[0]
+    C = coeffs.tocsr()
+    C_conj = C.conj()
+    rows = [(C.indices[C.indptr[i]:C.indptr[i+1]], C.data[C.indptr[i]:C.indptr[i+1]]) 
+            for i in range(norb)]
+    kl = numpy.arange(norb*norb).reshape(norb, norb)
+    with open(filename, 'w') as f:
+        f.write('&FCI NORBS=%d, NELEC=%d, MS2=0\n' % (norb, nelec))
+        f.write('ORBSYM=' + ''.join('%d,' % sym for sym in orbsym) + '\nISYM=1\nKSYM\n&END\n')
+        for i in range(norb):
+            for j in range(norb):
+                slab = numpy.zeros((norb, norb), dtype=complex)
+                for a, c_a in zip(*rows[i]):
+                    for b, c_b in zip(*rows[j]):
+                        slab += numpy.conj(c_a)*c_b*eri_slab(eri, norb, a, b)
+                #conj(C) slab C^T, with C sparse
+                slab = C.dot(C_conj.dot(slab).T).T.real
+                ks, ls = numpy.nonzero((abs(slab) >= tol) & (kl <= i*norb + j))
+                f.write(''.join('%20.12f  %d  %d  %d  %d\n' % (slab[k, l], i+1, j+1, k+1, l+1) 
+                                for k, l in zip(ks, ls)))
+        for i in range(norb):
+            for j in range(i, norb):
+                if abs(h1[i, j]) > tol:
+                    f.write('%20.12f  %d  %d  %d  %d\n' % (h1[i, j], i+1, j+1, 0, 0))
+        f.write('%20.12f  %d  %d  %d  %d\n' % (ecore, 0, 0, 0, 0))
+
+def group_rows(keys):
+    '''
+    Index from each distinct row of keys to the rows equal to it, as a dict 
+    {row bytes: row indices}, in order of first appearance
+    '''
+    if len(keys) == 0:
+        return {}
+    unique, inverse = numpy.unique(vec.void_keys(keys), return_inverse=True)
+    inverse = inverse.ravel()
+    order = numpy.argsort(inverse, kind='stable')
+    groups = numpy.split(order, numpy.cumsum(numpy.bincount(inverse))[:-1])
+    return {keys[group[0]].tobytes(): group for group in sorted(groups, key=lambda g: g[0])}
 
 class SymMethods():
     def __init__(self):
@@ -48,12 +134,16 @@ class SymMethods():
             self.partner_orbs = self.mf.partner_orbs
             self.xorbs = self.get_xorbs()
             self.porbs = {n+1: orb+1 for n, orb in enumerate(self.partner_orbs) }
+            #Partner of each orbital, 0-indexed (as the bits of packed keys)
+            self.partner_perm = numpy.array(self.partner_orbs, dtype=numpy.int64)
             print('ORB, PARTNER ORB:')
             for n, (orb, partner) in enumerate(self.porbs.items()):
                 print(self.orb_symm_labels[n], orb, partner)
         self.orb2lz = self.get_orb2lz()
         self.use_real_part = None #Use Hartree-Fock det from SHCI
         self.real2complex_coeffs = None
+        #Expansions of spin strings in real orbitals, by occupied orbs (see real_string)
+        self.real_strings = {}
 
     def real_or_imag_part(self, hf_det):
         rhf, ihf = self.convert_det_helper(hf_det)
@@ -79,37 +169,114 @@ class SymMethods():
         p = -1 if len([orb for orb in rest if orb < first])%2 else 1
         return p*self.rel_parity_old(rest)
 
-    def partner_config(self, config):
-        partner_occs = {self.porbs[orb]: config.occs[orb] for orb in config.occs}
-        up_orbs = [orb for orb in partner_occs if partner_occs[orb] > 0]
-        dn_orbs = [orb for orb in partner_occs if partner_occs[orb] == 2]
-        return vec.Config.fromorbs(up_orbs, dn_orbs) 
+    def bit_partners(self, n_bits):
+        #partner_perm extended to n_bits orbitals, the extra ones without partners
+        perm = numpy.arange(n_bits)
+        perm[:len(self.partner_perm)] = self.partner_perm
+        return perm
+
+    def partner_reps(self, keys):
+        '''
+        Canonical representatives of the packed configs keys (vec.config_keys) 
+        under swapping partner orbitals: the smaller bit string of each config 
+        and its partner config
+        '''
+        occ = vec.unpack_keys(keys)
+        partner = occ[:, :, self.bit_partners(occ.shape[2])]
+        flat, partner_flat = occ.reshape(len(keys), -1), partner.reshape(len(keys), -1)
+        first = numpy.argmax(flat != partner_flat, axis=1)
+        rows = numpy.arange(len(keys))
+        use_partner = partner_flat[rows, first] < flat[rows, first]
+        return vec.pack_keys(numpy.where(use_partner[:, None, None], partner, occ))
+
+    def pair_occ_reps(self, keys):
+        '''
+        Total occupation of each pair of partner orbitals (on the lower orbital) 
+        of the packed configs keys, the same for configs related by moving 
+        electrons within pairs
+        '''
+        occ = vec.unpack_keys(keys).astype(numpy.int64)
+        counts = 2*occ[:, 0] + occ[:, 1]
+        perm = self.bit_partners(counts.shape[1])
+        pair_counts = counts + counts[:, perm]
+        pair_counts[:, perm < numpy.arange(len(perm))] = 0
+        return pair_counts
 
     def real_orbs(self, orbs):
-        if not orbs:
-            return [(1, [])]
-        rot_first = self.real_orbs(orbs[:-1])
-        orb = orbs[-1]
-        if self.porbs[orb] == orb:
-            return [(f, orbs + [orb]) for f, orbs in rot_first]
+        rorbs = [(1, [])]
         root2inv = 1./math.sqrt(2)
-        xorb, yorb = (orb, self.porbs[orb]) if orb in self.xorbs else (self.porbs[orb], orb)
-        sign = -1 if (self.orb2lz[orb-1]%2) else 1
-        c_y = sign*1j*root2inv if orb in self.xorbs else -1j*root2inv
-        c_x = sign*root2inv if orb in self.xorbs else root2inv
-        rorbs = [(c*c_x, orbs + [xorb]) for c, orbs in rot_first if xorb not in orbs]
-        rorbs += [(c*c_y, orbs + [yorb]) for c, orbs in rot_first if yorb not in orbs]
+        for orb in orbs:
+            if self.porbs[orb] == orb:
+                rorbs = [(c, prev + [orb]) for c, prev in rorbs]
+                continue
+            xorb, yorb = (orb, self.porbs[orb]) if orb in self.xorbs else (self.porbs[orb], orb)
+            sign = -1 if (self.orb2lz[orb-1]%2) else 1
+            c_y = sign*1j*root2inv if orb in self.xorbs else -1j*root2inv
+            c_x = sign*root2inv if orb in self.xorbs else root2inv
+            rorbs = [(c*c_new, prev + [new]) for c_new, new in ((c_x, xorb), (c_y, yorb))
+                     for c, prev in rorbs if new not in prev]
         return rorbs
 
+    def real_string(self, orbs):
+        '''
+        real_orbs(orbs) with the parity of each term folded into its coef and 
+        its orbs sorted, as (coefs, [orbs]). Cached by orbs.
+        '''
+        key = tuple(orbs)
+        if key not in self.real_strings:
+            rorbs = self.real_orbs(list(key))
+            coefs = numpy.array([coef*rel_parity(orbs) for coef, orbs in rorbs], dtype=complex)
+            self.real_strings[key] = (coefs, [sorted(orbs) for coef, orbs in rorbs])
+        return self.real_strings[key]
+
+    def string_expansions(self, strings):
+        '''
+        Sparse matrix of the real_string expansions of strings (rows) in the 
+        real orbital strings it returns (columns)
+        '''
+        real_ids, real_strings = {}, []
+        cols, coefs, indptr = [], [], [0]
+        for orbs in strings:
+            string_coefs, rstrings = self.real_string(orbs)
+            for rstring in rstrings:
+                key = tuple(rstring)
+                if key not in real_ids:
+                    real_ids[key] = len(real_strings)
+                    real_strings.append(rstring)
+                cols.append(real_ids[key])
+            coefs.append(string_coefs)
+            indptr.append(len(cols))
+        #Built from indptr so each row keeps the order of real_string's terms
+        expansions = sparse.csr_matrix((numpy.concatenate(coefs), cols, indptr), 
+                                       shape=(len(strings), len(real_strings)))
+        return expansions, real_strings
+
+    def first_terms(self, U, D, up_ids, dn_ids):
+        '''
+        The (real up string, real dn string) index pairs (as up*n_dn + dn) of the 
+        terms of the dets (up_ids, dn_ids) with nonzero real (or imag) part, 
+        sorted, and the position of the first term giving each. Terms are taken 
+        det by det, each det's as in convert_det_helper (up terms outer).
+        '''
+        n_up, n_dn = numpy.diff(U.indptr)[up_ids], numpy.diff(D.indptr)[dn_ids]
+        sizes = n_up*n_dn
+        det_of = numpy.repeat(numpy.arange(len(up_ids)), sizes)
+        n = numpy.arange(sizes.sum()) - numpy.repeat(numpy.cumsum(sizes) - sizes, sizes)
+        up_terms = U.indptr[up_ids][det_of] + n//n_dn[det_of]
+        dn_terms = D.indptr[dn_ids][det_of] + n%n_dn[det_of]
+        coefs = U.data[up_terms]*D.data[dn_terms]
+        part = coefs.real if self.use_real_part else coefs.imag
+        keep = abs(part) >= vec.tol
+        pairs = U.indices[up_terms[keep]]*D.shape[1] + D.indices[dn_terms[keep]]
+        return numpy.unique(pairs, return_index=True)
+
     def convert_det_helper(self, det):
-        rdet, idet = vec.Vec.zero(), vec.Vec.zero()
-        rup = self.real_orbs(det.up_occ)
-        rdn = self.real_orbs(det.dn_occ)
-        for ucoef, up in rup:
-            for dcoef, dn in rdn:
-                coef = rel_parity(up)*rel_parity(dn)*ucoef*dcoef
-                rdet += coef.real*vec.Det(up, dn)
-                idet += coef.imag*vec.Det(up, dn)
+        ucoefs, ups = self.real_string(det.up_occ)
+        dcoefs, dns = self.real_string(det.dn_occ)
+        coefs = numpy.outer(ucoefs, dcoefs).ravel()
+        dets = [vec.Det(up, dn) for up in ups for dn in dns]
+        rdet = vec.Vec.linear_combination(coefs.real, dets)
+        idet = vec.Vec.linear_combination(coefs.imag, dets)
         return rdet, idet
 
     def convert_det(self, det):
@@ -127,13 +294,30 @@ class SymMethods():
         return [self.ir_lz(ir) for ir in self.orbsym]
 
     def convert_wf(self, dets, wf_coeffs):
-        rwf, iwf = vec.Vec.zero(), vec.Vec.zero()
-        for det, coef in zip(dets, wf_coeffs):
-            rdet, idet = self.convert_det_helper(det)
-            rwf += coef*rdet
-            iwf += coef*idet
-        #assert(self.use_real_part == (rwf.norm() >= iwf.norm()))
-        converted_wf = rwf if self.use_real_part else iwf
+        '''
+        Real (or imag) part of the wf in real orbitals. The wf is factored as a 
+        sparse matrix W over its unique up strings x unique dn strings. With U 
+        and D the expansions of those strings in real orbital strings (see 
+        string_expansions), the converted wf is U^T W D.
+        '''
+        if not dets:
+            return [], []
+        up_ids, up_strings = index_strings([det.up_occ for det in dets])
+        dn_ids, dn_strings = index_strings([det.dn_occ for det in dets])
+        W = sparse.csr_matrix((wf_coeffs, (up_ids, dn_ids)), 
+                              shape=(len(up_strings), len(dn_strings)))
+        U, real_ups = self.string_expansions(up_strings)
+        D, real_dns = self.string_expansions(dn_strings)
+        terms, first = self.first_terms(U, D, up_ids, dn_ids)
+        wf = U.T.dot(W).dot(D).tocoo()
+        #assert(self.use_real_part == (norm(wf.data.real) >= norm(wf.data.imag)))
+        part = wf.data.real if self.use_real_part else wf.data.imag
+        #Dets in order of their first term, as when summing det by det
+        keep = numpy.flatnonzero(abs(part) > vec.tol)
+        position = first[numpy.searchsorted(terms, wf.row[keep]*D.shape[1] + wf.col[keep])]
+        order = keep[numpy.argsort(position, kind='stable')]
+        converted_wf = vec.Vec({vec.Det(real_ups[wf.row[n]], real_dns[wf.col[n]]): part[n] 
+                                for n in order})
 
 #        iwf_list = sorted([(det, coef) for det, coef in iwf.dets.items()],
 #                          key = lambda det_coef: -abs(det_coef[1]))
@@ -159,7 +343,7 @@ class SymMethods():
             rcsf += coef*rdet if self.use_real_part else coef*idet
         return rcsf
 
-    def get_real2complex_coeffs(self, h1, eri, norb, nelec, ecore, orbsym, partner_orbs):
+    def get_real2complex_coeffs(self, norb, nelec, orbsym, partner_orbs):
         coeffs, num_rows, row_index, row_coeffs, orbsym = \
             self.realToComplex(norb, nelec, orbsym, partner_orbs)
         self.real2complex_coeffs = coeffs
@@ -169,26 +353,14 @@ class SymMethods():
             self.realToComplex(norb, nelec, orbsym, partner_orbs)
     
         self.real2complex_coeffs = coeffs
-        new_h1 = reduce(numpy.dot, (coeffs, h1, coeffs.conj().T)).real
-        eri = pyscf.ao2mo.restore(1, eri, norb)
-        new_eri = numpy.zeros_like(eri)
-    
-        transformComplex(norb,
-                         numpy.ascontiguousarray(num_rows, numpy.int32),
-                         numpy.ascontiguousarray(row_index, numpy.int32),
-                         numpy.ascontiguousarray(row_coeffs, numpy.float64),
-                         numpy.ascontiguousarray(eri, numpy.float64),
-                         numpy.ascontiguousarray(new_eri, numpy.float64))
-     
-        writeIntNoSymm(norb,
-                       numpy.ascontiguousarray(new_h1, numpy.float64),
-                       numpy.ascontiguousarray(new_eri, numpy.float64),
-                       ecore,
-                       nelec,
-                       numpy.ascontiguousarray(orbsym, numpy.int32))
+        new_h1 = coeffs.rotate(h1).real
+        write_complex_fcidump('FCIDUMP', new_h1, eri, coeffs, ecore, nelec, orbsym)
 
     def realToComplex(self, norb, nelec, orbsym, partner_orbs):
-        coeffs = numpy.zeros(shape=(norb, norb)).astype(complex)
+        #coeffs (rows: complex orbs, cols: real orbs) as a Real2Complex
+        diag = numpy.zeros(shape=(norb, ), dtype=complex)
+        offdiag = numpy.zeros(shape=(norb, ), dtype=complex)
+        partner = numpy.arange(norb)
         num_rows = numpy.zeros(shape=(norb, ), dtype=int)
         row_index = numpy.zeros(shape=(2 * norb, ), dtype=int)
         row_coeffs = numpy.zeros(shape=(2 * norb, ), dtype=float)
@@ -201,7 +373,7 @@ class SymMethods():
         for ir in A_irrep_ids:
             is_gerade = ir in (0, 1)
             for i in numpy.where(orbsym == ir)[0]:
-                coeffs[i, i] = 1.0
+                diag[i] = 1.0
                 num_rows[i] = 1
                 row_index[2 * i] = i
                 row_coeffs[2 * i] = 1.
@@ -244,12 +416,14 @@ class SymMethods():
                 row_index[2 * ix], row_index[2 * ix + 1] = ix, iy
                 row_index[2 * iy], row_index[2 * iy + 1] = ix, iy
         
-                coeffs[ix, ix], coeffs[ix, iy] = ((-1)**l) * 1.0 / (2.0**0.5), (
+                partner[ix], partner[iy] = iy, ix
+                diag[ix], offdiag[ix] = ((-1)**l) * 1.0 / (2.0**0.5), (
                     (-1)**l) * 1.0j / (2.0**0.5)
-                coeffs[iy, ix], coeffs[iy, iy] = 1.0 / (2.0**0.5), -1.0j / (2.0** 0.5)
+                offdiag[iy], diag[iy] = 1.0 / (2.0**0.5), -1.0j / (2.0** 0.5)
                 row_coeffs[2 * ix], row_coeffs[2 * ix + 1] = (
                     (-1)**l) * 1.0 / (2.0**0.5), ((-1)**l) * 1.0 / (2.0**0.5)
                 row_coeffs[2 * iy], row_coeffs[
                     2 * iy + 1] = 1.0 / (2.0**0.5), -1.0 / (2.0**0.5)
     
+        coeffs = Real2Complex(diag, offdiag, partner)
         return coeffs, num_rows, row_index, row_coeffs, new_orbsym
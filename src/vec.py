@@ -2,6 +2,8 @@ import copy
 import numpy
 import bisect
 
+import shci4qmc.src.bits as bits
+
 tol = 1e-15
 
 class Vec:
@@ -32,22 +34,46 @@ class Vec:
     def zero():
         return Vec({})
 
+    @classmethod
+    def fromvec(cls, vec):
+        '''vec in this backend (vec itself if it already is one)'''
+        return vec if type(vec) is cls else cls(vec.dets)
+
+    @classmethod
+    def linear_combination(cls, coefs, vecs):
+        '''sum(coef*vec) built in one pass. vecs may be Vecs or Dets'''
+        res = cls.zero()
+        for coef, vec in zip(coefs, vecs):
+            res.axpy(coef, vec)
+        return res
+
     @staticmethod
-    def gram_schmidt(vecs, dim, tol=tol):
-        orthonormal_basis = []
-        for vec in vecs: #for vec in numpy.copy(vecs):
-            new_vec = Vec.zero()
+    def gram_schmidt(vecs, dim, tol=tol, return_indices=False):
+        '''
+        Orthonormalizes vecs in order, dropping those with norm <= tol after 
+        projection. With return_indices, also returns the position in vecs of 
+        each vec kept.
+        '''
+        orthonormal_basis, kept = [], []
+        for n, vec in enumerate(vecs): #for vec in numpy.copy(vecs):
+            new_vec = vec.zero()
             new_vec += vec #vs. numpy.copy(vecs)
             if len(orthonormal_basis) == dim:
-                return orthonormal_basis
+                break
             for basis_vec in orthonormal_basis:
-                new_vec += -basis_vec.dot(new_vec) * basis_vec
+                new_vec.axpy(-basis_vec.dot(new_vec), basis_vec)
             if new_vec.norm() <= tol:
                 continue
             new_vec /= new_vec.norm()
             new_vec.config_label = vec.config_label
             orthonormal_basis.append(new_vec)
-        return orthonormal_basis
+            kept.append(n)
+        return (orthonormal_basis, kept) if return_indices else orthonormal_basis
+
+    def drop_small(self, tol):
+        small = [det for det, coef in self.dets.items() if abs(coef) < tol]
+        for det in small:
+            del self.dets[det]
 
     def __repr__(self):
         if len(self.dets) == 0:
@@ -60,20 +86,25 @@ class Vec:
         return '' if coeff == 1 else "%14.4e"%coeff
 
     def __iadd__(self, other):
-        if isinstance(other, Vec):
-            for det in other.dets:
-                if det in self.dets:
-                    self.dets[det] += other.dets[det]
-                    if (abs(self.dets[det]) < tol): 
-                        del self.dets[det]
-                else:
-                    self.dets[det] = other.dets[det]
-            return self
-        elif isinstance(other, Det):
-            self += 1*other
-            return self
+        return self.axpy(1, other)
+
+    def axpy(self, alpha, other):
+        '''self += alpha*other, without building alpha*other'''
+        if isinstance(other, Det):
+            other_dets = {other: 1}
+        elif isinstance(other, Vec):
+            other_dets = other.dets
         else:
             raise TypeError("Cannot add type " + str(type(other)) + " to Vec")
+        dets = self.dets
+        items = list(other_dets.items()) if other is self else other_dets.items()
+        for det, coef in items:
+            coef = dets.get(det, 0) + alpha*coef
+            if abs(coef) < tol:
+                dets.pop(det, None)
+            else:
+                dets[det] = coef
+        return self
 
     def __imul__(self, scalar):
         for det, coef in self.dets.items():
@@ -92,12 +123,245 @@ class Vec:
     def __eq__(self, other):
         return self.dets == other.dets
 
+class ArrayVec(Vec):
+    '''
+    Array-backed alternative to Vec. Determinants are stored as rows of 
+    packed occupation words (up words, then dn words, see bits.py) kept 
+    sorted and unique, with the coefficients in a parallel ndarray, so sums, 
+    dot products and norms are merge-based numpy operations rather than 
+    per-determinant dict updates. Supports the Vec interface; .dets builds 
+    (and caches) the equivalent det -> coef dict on demand.
+    '''
+    def __init__(self, det_dict={}):
+        dets = list(det_dict.keys())
+        coefs = numpy.array([det_dict[det] for det in dets])
+        self.keys, self.coefs = canonical_keys(det_keys(dets), coefs)
+        self.config_label = None
+        self._dets = None
+
+    @classmethod
+    def fromarrays(cls, keys, coefs):
+        '''keys: (ndet, 2*n_words) uint64 array, need not be sorted or unique'''
+        res = cls()
+        res.keys, res.coefs = canonical_keys(keys, numpy.asarray(coefs))
+        return res
+
+    @property
+    def dets(self):
+        if self._dets is None:
+            self._dets = dict(zip(keys2dets(self.keys), self.coefs))
+        return self._dets
+
+    def _update(self, keys, coefs):
+        self.keys, self.coefs = keys, coefs
+        self._dets = None
+
+    def norm(self):
+        return numpy.sqrt(numpy.vdot(self.coefs, self.coefs))
+
+    def dot(self, other):
+        other = ArrayVec.fromvec(other)
+        if len(self.coefs) == 0 or len(other.coefs) == 0:
+            return 0
+        keys, other_keys = [void_keys(k) for k in pad_keys(self.keys, other.keys)]
+        idx = numpy.minimum(numpy.searchsorted(keys, other_keys), len(keys) - 1)
+        match = keys[idx] == other_keys
+        return numpy.vdot(self.coefs[idx[match]], other.coefs[match])
+
+    @staticmethod
+    def zero():
+        return ArrayVec({})
+
+    def drop_small(self, tol):
+        keep = abs(self.coefs) >= tol
+        self._update(self.keys[keep], self.coefs[keep])
+
+    def axpy(self, alpha, other):
+        '''self += alpha*other as a single merge'''
+        return self._merge([1, alpha], [self, other])
+
+    @classmethod
+    def linear_combination(cls, coefs, vecs):
+        '''
+        sum(coef*vec) as a single merge: the keys of every term are 
+        concatenated and reduced once. vecs may be Vecs or Dets.
+        '''
+        return cls()._merge(coefs, vecs)
+
+    def _merge(self, coefs, vecs):
+        dets, det_coefs, keys, vec_coefs = [], [], [], []
+        for coef, vec in zip(coefs, vecs):
+            if isinstance(vec, Det):
+                dets.append(vec)
+                det_coefs.append(coef)
+            elif isinstance(vec, Vec):
+                vec = ArrayVec.fromvec(vec)
+                keys.append(vec.keys)
+                vec_coefs.append(coef*vec.coefs)
+            else:
+                raise TypeError("Cannot add type " + str(type(vec)) + " to ArrayVec")
+        keys.append(det_keys(dets))
+        vec_coefs.append(numpy.array(det_coefs))
+        self._update(*canonical_keys(
+            numpy.concatenate(pad_keys(*keys)), numpy.concatenate(vec_coefs)))
+        return self
+
+    def __imul__(self, scalar):
+        self._update(self.keys, self.coefs*scalar)
+        return self
+
+    def __rmul__(self, scalar):
+        res = ArrayVec()
+        res.keys, res.coefs = self.keys, scalar*self.coefs
+        return res
+
+def det_keys(dets, n_words = 1):
+    '''Rows of packed (up words, dn words) for each det, padded to a common width'''
+    n_words = max([n_words] + [max(len(det.up_bits), len(det.dn_bits)) for det in dets])
+    pad = lambda words: words + (0,)*(n_words - len(words))
+    keys = numpy.array([pad(det.up_bits) + pad(det.dn_bits) for det in dets], dtype=numpy.uint64)
+    return keys.reshape(len(dets), 2*n_words)
+
+def config_keys(configs, n_words = 1):
+    '''Rows of packed (closed words, open words) for each config, padded to a common width'''
+    n_words = max([n_words] + [max(len(config.closed_bits), len(config.open_bits)) 
+                               for config in configs])
+    pad = lambda words: words + (0,)*(n_words - len(words))
+    keys = numpy.array([pad(config.closed_bits) + pad(config.open_bits) for config in configs], 
+                       dtype=numpy.uint64)
+    return keys.reshape(len(configs), 2*n_words)
+
+def words2bits(words):
+    return bits.trim([int(word) for word in words])
+
+def keys2dets(keys):
+    '''Dets for rows of packed (up words, dn words), the inverse of det_keys'''
+    n_words = keys.shape[1]//2
+    return [Det.frombits(words2bits(key[:n_words]), words2bits(key[n_words:])) for key in keys]
+
+def orb_words(orbs, n_words):
+    '''Packed one-orbital strings: words[..., w] for each (1-indexed) orbital in orbs'''
+    orbs = numpy.asarray(orbs, dtype=numpy.int64) - 1
+    word, bit = orbs//bits.WORD_BITS, (orbs%bits.WORD_BITS).astype(numpy.uint64)
+    hit = word[..., None] == numpy.arange(n_words)
+    return numpy.where(hit, numpy.left_shift(numpy.uint64(1), bit)[..., None], numpy.uint64(0))
+
+def below_words(orbs, n_words):
+    '''Packed strings of the orbitals 1, ..., orb-1 for each orbital in orbs'''
+    orbs = numpy.asarray(orbs, dtype=numpy.int64) - 1
+    word, bit = orbs//bits.WORD_BITS, (orbs%bits.WORD_BITS).astype(numpy.uint64)
+    part = numpy.left_shift(numpy.uint64(1), bit) - numpy.uint64(1)
+    w = numpy.arange(n_words)
+    return numpy.where(w < word[..., None], numpy.uint64(bits.WORD_MASK),
+                       numpy.where(w == word[..., None], part[..., None], numpy.uint64(0)))
+
+_byte_counts = numpy.array([bits.popcount(n) for n in range(256)], dtype=numpy.int64)
+
+def popcount_words(words):
+    '''Number of occupied orbitals in each packed string words[..., :]'''
+    words = numpy.ascontiguousarray(words, dtype=numpy.uint64)
+    return _byte_counts[words.view(numpy.uint8)].sum(axis=-1)
+
+def lowest_orbs(words):
+    '''Lowest occupied (1-indexed) orbital of each row of packed strings, 0 if empty'''
+    occupied = words != 0
+    first = numpy.argmax(occupied, axis=1)
+    word = words[numpy.arange(len(words)), first]
+    low = word & (~word + numpy.uint64(1))
+    bit = numpy.log2(numpy.where(low, low, 1).astype(float)).astype(numpy.int64)
+    return numpy.where(numpy.any(occupied, axis=1), first*bits.WORD_BITS + bit + 1, 0)
+
+def unpack_keys(keys):
+    '''Occupations (0/1) in each row of packed keys, shape (n, 2, n_bits); orbital n at [..., n-1]'''
+    n, n_words = len(keys), keys.shape[1]//2
+    occ = numpy.unpackbits(numpy.ascontiguousarray(keys, dtype='<u8').view(numpy.uint8), 
+                           bitorder='little')
+    return occ.reshape(n, 2, n_words*bits.WORD_BITS)
+
+def pack_keys(occ):
+    '''Packed keys of occupations (n, 2, n_bits), the inverse of unpack_keys'''
+    n = len(occ)
+    words = numpy.packbits(numpy.ascontiguousarray(occ, dtype=numpy.uint8).reshape(n, -1), 
+                           axis=1, bitorder='little')
+    return words.view('<u8').astype(numpy.uint64).reshape(n, -1)
+
+def occ_orbs(keys):
+    '''
+    Occupied orbitals of each row of packed (up words, dn words), in the 
+    order of Det.up_occ + Det.dn_occ, as rows padded at the end with 0
+    '''
+    occ = unpack_keys(keys)
+    n, n_bits = len(keys), occ.shape[2]
+    rows, cols = numpy.nonzero(occ.reshape(n, 2*n_bits))
+    counts = numpy.bincount(rows, minlength=n)
+    starts = numpy.concatenate([[0], numpy.cumsum(counts)[:-1]])
+    res = numpy.zeros((n, counts.max() if n else 0), dtype=numpy.int64)
+    res[rows, numpy.arange(len(rows)) - starts[rows]] = cols%n_bits + 1
+    return res
+
+def pad_keys(*key_arrays):
+    '''Pads the up and dn words of key arrays to a common number of words'''
+    def pad(keys, n_words):
+        n, old = len(keys), keys.shape[1]//2
+        if old == n_words:
+            return keys
+        res = numpy.zeros((n, 2, n_words), dtype=numpy.uint64)
+        res[:, :, :old] = keys.reshape(n, 2, old)
+        return res.reshape(n, 2*n_words)
+    n_words = max(keys.shape[1] for keys in key_arrays)//2
+    return [pad(keys, n_words) for keys in key_arrays]
+
+def void_keys(keys):
+    #View each row as a single opaque scalar so rows sort/search as a whole
+    keys = numpy.ascontiguousarray(keys)
+    return keys.view(numpy.dtype((numpy.void, keys.dtype.itemsize*keys.shape[1]))).ravel()
+
+def canonical_keys(keys, coefs):
+    '''Sorts keys, sums the coefficients of repeated keys and drops zeros'''
+    if len(coefs) == 0:
+        return keys, coefs
+    order = numpy.argsort(void_keys(keys), kind='stable')
+    keys, coefs = keys[order], coefs[order]
+    is_new = numpy.ones(len(keys), dtype=bool)
+    is_new[1:] = numpy.any(keys[1:] != keys[:-1], axis=1)
+    starts = numpy.flatnonzero(is_new)
+    keys, coefs = keys[starts], numpy.add.reduceat(coefs, starts)
+    keep = abs(coefs) > tol
+    return keys[keep], coefs[keep]
+
+def vec_type(rep):
+    if rep == 'dict':
+        return Vec
+    elif rep == 'array':
+        return ArrayVec
+    raise Exception('Unknown vec rep \'' + rep + '\'')
+
 class Det:
     def __init__(self, up_occ, dn_occ):
         self.up_occ = sorted(up_occ)
         self.dn_occ = sorted(dn_occ)
+        #Packed occupations (see bits.py), used for hashing/comparison
+        self.up_bits = bits.pack(self.up_occ)
+        self.dn_bits = bits.pack(self.dn_occ)
         self.my_hash = None #self._get_hash()
 
+    @classmethod
+    def frombits(cls, up_bits, dn_bits):
+        return cls(bits.unpack(up_bits), bits.unpack(dn_bits))
+
+    def excitation_degree(self, other):
+        return (bits.n_diff(self.up_bits, other.up_bits) 
+                + bits.n_diff(self.dn_bits, other.dn_bits))//2
+
+    def excitation(self, other):
+        '''
+        Returns ((up_from, up_to), (dn_from, dn_to), parity) for the 
+        excitation taking self to other
+        '''
+        up_from, up_to, up_parity = bits.excitation(self.up_bits, other.up_bits)
+        dn_from, dn_to, dn_parity = bits.excitation(self.dn_bits, other.dn_bits)
+        return (up_from, up_to), (dn_from, dn_to), up_parity*dn_parity
+
     def get_Sz(self):
         return (len(self.up_occ) - len(self.dn_occ))/2
 
@@ -122,11 +386,11 @@ class Det:
 
     def _get_hash(self):
         #return hash(self.__repr__())
-        return hash((tuple(self.up_occ), tuple(self.dn_occ)))
+        return hash((self.up_bits, self.dn_bits))
 
     def __eq__(self, other):
-        return (self.up_occ == other.up_occ 
-                and self.dn_occ == other.dn_occ)
+        return (self.up_bits == other.up_bits 
+                and self.dn_bits == other.dn_bits)
 
     def __repr__(self):
         return self._get_repr()
@@ -148,8 +412,10 @@ class Config:
             self.occs[up_orb] = 1
         for dn_orb in det.dn_occ:
             self.occs[dn_orb] = 1 if dn_orb not in self.occs else 2
-        self.num_open = \
-            sum([1 if self.occs[orb] == 1 else 0 for orb in self.occs])
+        #Packed doubly/singly occupied orbitals
+        self.closed_bits = bits.and_(det.up_bits, det.dn_bits)
+        self.open_bits = bits.xor(det.up_bits, det.dn_bits)
+        self.num_open = bits.count(self.open_bits)
         self.config_str = self.make_config_str()
 
     @classmethod
@@ -161,13 +427,14 @@ class Config:
         return '_'.join([str(orb)+'S'+str(self.occs[orb]) for orb in orbs])
 
     def __hash__(self):
-        return hash(self.__repr__())
+        return hash((self.closed_bits, self.open_bits))
 
     def __repr__(self):
         return self.config_str
 
     def __eq__(self, other):
-        return self.occs == other.occs 
+        return (self.closed_bits == other.closed_bits 
+                and self.open_bits == other.open_bits)
 
     def __lt__(self, other):
         return self.config_str < other.config_str